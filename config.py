@@ -19,6 +19,66 @@ class Config(object):
         }
     }
 
+    # Jobs
+    # maximum number of devices processed at the same time, all jobs included
+    JOB_MAX_WORKERS = int(environ.get('JOB_MAX_WORKERS', 100))
+    # the results of a run can be followed live (long polling), and are
+    # kept in memory for JOB_PROGRESS_TTL seconds after the end of the run
+    # (in the memory of the worker running the job: live progress needs a
+    # single gunicorn worker)
+    JOB_PROGRESS_TTL = 300
+    JOB_PROGRESS_MAX_TIMEOUT = 30
+    # maximum number of device results kept in memory per run
+    JOB_PROGRESS_MAX_RESULTS = 10000
+    # the status of a running workflow is read from memory by the workflow
+    # builder, and saved in the database every WORKFLOW_STATUS_INTERVAL
+    # seconds
+    WORKFLOW_STATUS_INTERVAL = 10
+    # maximum number of workflow branches running at the same time, all
+    # workflows included (a workflow runs its jobs in its own thread when
+    # no thread is available)
+    WORKFLOW_MAX_BRANCHES = int(environ.get('WORKFLOW_MAX_BRANCHES', 20))
+    # in a workflow, the results of a job larger than PAYLOAD_SPILL_THRESHOLD
+    # bytes (JSON) are written to PAYLOAD_SPILL_PATH (default: the temporary
+    # directory) until the jobs that depend on them have run
+    PAYLOAD_SPILL_THRESHOLD = int(
+        environ.get('PAYLOAD_SPILL_THRESHOLD', 1048576)
+    )
+    PAYLOAD_SPILL_PATH = environ.get('PAYLOAD_SPILL_PATH')
+
+    # Netmiko / Napalm connection pool
+    # sessions are reused by all jobs of a workflow run, and across runs
+    # if the pool is persistent
+    CONNECTION_POOL_PERSISTENT = int(
+        environ.get('CONNECTION_POOL_PERSISTENT', False)
+    )
+    CONNECTION_POOL_IDLE_TIMEOUT = 300
+    CONNECTION_POOL_MAX_SESSIONS = 2
+    CONNECTION_POOL_SIZE = 1000
+    # a job waits at most CONNECTION_POOL_WAIT_TIMEOUT seconds for a session
+    # when a device already has CONNECTION_POOL_MAX_SESSIONS sessions
+    CONNECTION_POOL_WAIT_TIMEOUT = 60
+
+    # Syslog
+    # received messages are kept in a ring buffer of SYSLOG_QUEUE_SIZE
+    # messages, and saved in batches of SYSLOG_BATCH_SIZE messages at least
+    # every SYSLOG_BATCH_INTERVAL milliseconds
+    SYSLOG_QUEUE_SIZE = int(environ.get('SYSLOG_QUEUE_SIZE', 100000))
+    SYSLOG_BATCH_SIZE = 1000
+    SYSLOG_BATCH_INTERVAL = 200
+    # a job triggered by a log rule runs at most once per LOG_TRIGGER_WINDOW
+    # seconds for a given source, with all the logs received in between
+    LOG_TRIGGER_WINDOW = int(environ.get('LOG_TRIGGER_WINDOW', 5))
+    # logs are deleted after LOG_RETENTION days (0 to keep them forever).
+    # The retention can also be set per source (IP address: number of days),
+    # and per log rule for the logs matched by the rule.
+    LOG_RETENTION = int(environ.get('LOG_RETENTION', 0))
+    LOG_SOURCE_RETENTION = {}
+    LOG_PURGE_INTERVAL = 3600
+    LOG_PURGE_BATCH_SIZE = 10000
+    # deleted logs are archived in compressed files (empty: no archive)
+    LOG_ARCHIVE_PATH = environ.get('LOG_ARCHIVE_PATH', 'logs/archives')
+
     # WebSSH (GoTTY)
     GOTTY_PORT_REDIRECTION = int(environ.get('GOTTY_PORT_REDIRECTION', False))
     GOTTY_SERVER_ADDR = environ.get('GOTTY_SERVER_ADDR')
@@ -26,6 +86,9 @@ class Config(object):
 
     # Vault
     USE_VAULT = False
+    # device credentials are cached in memory for VAULT_CACHE_TTL seconds
+    VAULT_CACHE_TTL = int(environ.get('VAULT_CACHE_TTL', 300))
+    VAULT_PREFETCH_WORKERS = 20
 
 
 class DebugConfig(Config):
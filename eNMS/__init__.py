@@ -19,6 +19,10 @@ login_manager = LoginManager()
 scheduler = APScheduler()
 
 from eNMS.admin.models import User
+from eNMS.automation.connections import connection_pool
+from eNMS.automation.executor import executor
+from eNMS.automation.payload import payload_stores
+from eNMS.automation.progress import job_progress
 from eNMS.base.default import (
     create_default_network_topology,
     create_default_parameters,
@@ -29,14 +33,27 @@ from eNMS.base.default import (
     process_pool_properties
 )
 from eNMS.base.rest import configure_rest_api
+from eNMS.logs.models import (
+    create_missing_full_text_index,
+    job_triggers,
+    log_ingestion
+)
+from eNMS.logs.retention import log_retention
 
 
 def register_extensions(app):
     db.init_app(app)
     login_manager.init_app(app)
+    executor.init_app(app)
+    connection_pool.init_app(app)
+    job_progress.init_app(app)
+    payload_stores.init_app(app)
+    log_ingestion.init_app(app)
+    job_triggers.init_app(app)
     if not scheduler.running:
         scheduler.init_app(app)
         scheduler.start()
+    log_retention.init_app(app)
 
 
 def register_blueprints(app):
@@ -87,6 +104,7 @@ def configure_database(app):
         create_service_classes()
         process_pool_properties()
         db.create_all()
+        create_missing_full_text_index()
         create_default_users()
         create_default_parameters()
         create_default_network_topology(app)
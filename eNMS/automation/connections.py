@@ -0,0 +1,188 @@
+from collections import Counter, defaultdict, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Condition
+from time import time
+
+
+class Checkout(object):
+
+    # the sessions used by one call of a service (for one device): they
+    # belong to the call, whatever the thread or the coroutine that opened
+    # them.
+    def __init__(self, stop=None):
+        self.sessions, self.stop = set(), stop
+
+
+class ConnectionPool(object):
+
+    def __init__(self):
+        self.condition = Condition()
+        self.current = ContextVar('checkout', default=None)
+        # idle sessions, from the least to the most recently used
+        self.idle = OrderedDict()
+        self.idle_keys = defaultdict(list)
+        # sessions currently used by a service, and their number per device
+        self.sessions, self.active = {}, Counter()
+        self.scopes = 0
+        self.persistent = False
+        self.idle_timeout, self.max_sessions, self.size = 300, 2, 1000
+        self.wait_timeout = 60
+
+    def init_app(self, app):
+        self.persistent = app.config['CONNECTION_POOL_PERSISTENT']
+        self.idle_timeout = app.config['CONNECTION_POOL_IDLE_TIMEOUT']
+        self.max_sessions = app.config['CONNECTION_POOL_MAX_SESSIONS']
+        self.size = app.config['CONNECTION_POOL_SIZE']
+        self.wait_timeout = app.config['CONNECTION_POOL_WAIT_TIMEOUT']
+
+    @property
+    def enabled(self):
+        return self.persistent or self.scopes > 0
+
+    @contextmanager
+    def checkout(self, stop=None):
+        # the sessions opened during the call and not released by the
+        # service are closed at the end of the call. The checkout follows
+        # the call in the threads it uses (see executor.run_in_thread).
+        checkout = Checkout(stop)
+        token = self.current.set(checkout)
+        try:
+            yield checkout
+        finally:
+            self.current.reset(token)
+            self.release_checked_out(checkout)
+
+    @contextmanager
+    def scope(self):
+        # sessions are kept open for reuse as long as at least one scope
+        # (a workflow run) is open, or indefinitely if the pool is persistent
+        with self.condition:
+            self.scopes += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.scopes -= 1
+                expired = self.sweep(flush=not self.enabled)
+            self.close_all(expired)
+
+    def connect(self, key, device, open, is_alive, close):
+        # waiting for a session of the device stops when the job stops, or
+        # after "wait_timeout" seconds
+        checkout = self.current.get()
+        stop = checkout and checkout.stop
+        deadline = time() + self.wait_timeout
+        with self.condition:
+            while self.active[device] >= self.max_sessions:
+                reason = stop and stop()
+                if reason:
+                    raise RuntimeError(reason)
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f'No session available for device {device} '
+                        f'after {self.wait_timeout} seconds'
+                    )
+                self.condition.wait(min(remaining, 1))
+            self.active[device] += 1
+        try:
+            while True:
+                with self.condition:
+                    expired, session = self.sweep(), self.pop_idle(key)
+                self.close_all(expired)
+                if not session:
+                    connection = open()
+                    break
+                connection = session[1]
+                if self.alive(connection, is_alive):
+                    break
+                self.close_all([session])
+        except Exception:
+            with self.condition:
+                self.active[device] -= 1
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.sessions[id(connection)] = (
+                key,
+                connection,
+                close,
+                device,
+                checkout
+            )
+            if checkout:
+                checkout.sessions.add(id(connection))
+        return connection
+
+    def release(self, connection, reusable=True):
+        with self.condition:
+            key, _, close, device, checkout = self.sessions.pop(
+                id(connection)
+            )
+            if checkout:
+                checkout.sessions.discard(id(connection))
+            self.active[device] -= 1
+            self.condition.notify_all()
+            if reusable and self.enabled:
+                self.idle[id(connection)] = (key, connection, close, time())
+                self.idle_keys[key].append(id(connection))
+                expired = self.sweep()
+            else:
+                expired = [(key, connection, close, None)]
+        self.close_all(expired)
+
+    def release_checked_out(self, checkout):
+        # sessions left open by a service that failed are in an unknown
+        # state: they are closed instead of being returned to the pool.
+        with self.condition:
+            sessions = [
+                self.sessions[session_id]
+                for session_id in checkout.sessions
+                if session_id in self.sessions
+            ]
+        for session in sessions:
+            self.release(session[1], reusable=False)
+
+    def pop_idle(self, key):
+        session_ids = self.idle_keys.get(key)
+        if not session_ids:
+            return None
+        session = self.idle.pop(session_ids.pop())
+        if not session_ids:
+            del self.idle_keys[key]
+        return session
+
+    def sweep(self, flush=False):
+        # least recently used sessions are evicted first, when they have
+        # been idle for too long or when the pool is full.
+        expired, now = [], time()
+        while self.idle:
+            session_id, (key, *_, released) = next(iter(self.idle.items()))
+            if not (
+                flush
+                or len(self.idle) > self.size
+                or now - released > self.idle_timeout
+            ):
+                break
+            expired.append(self.idle.pop(session_id))
+            self.idle_keys[key].remove(session_id)
+            if not self.idle_keys[key]:
+                del self.idle_keys[key]
+        return expired
+
+    def alive(self, connection, is_alive):
+        try:
+            return is_alive(connection)
+        except Exception:
+            return False
+
+    def close_all(self, sessions):
+        for _, connection, close, _ in sessions:
+            try:
+                close(connection)
+            except Exception:
+                pass
+
+
+connection_pool = ConnectionPool()
@@ -0,0 +1,376 @@
+from asyncio import (
+    CancelledError,
+    ensure_future,
+    new_event_loop,
+    Semaphore,
+    sleep as async_sleep,
+    TimeoutError as AsyncTimeoutError,
+    wait as async_wait,
+    wait_for,
+    wrap_future
+)
+from collections import Counter, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait
+)
+from contextvars import ContextVar, copy_context
+from heapq import heappop, heappush
+from itertools import count
+from threading import BoundedSemaphore, local
+from time import sleep, time
+
+
+def failure(reason):
+    return {'success': False, 'result': reason}
+
+
+def retry_delay(retry, result, attempt):
+    if retry and not result['success']:
+        return retry(attempt)
+
+
+class JobExecutor(object):
+
+    def __init__(self):
+        self.pool = self.branches = self.branch_slots = None
+        self.context = local()
+        # threads started by the current attempt of an asynchronous job
+        self.threads = ContextVar('threads', default=None)
+        # time a worker waits for a blocking call of an asynchronous job to
+        # be picked up by the pool, before running it itself
+        self.pickup_timeout = 0.1
+
+    def init_app(self, app):
+        # the pool is shared by all jobs and lives as long as the process:
+        # its size is the global limit on the number of devices being
+        # processed at the same time.
+        if not self.pool:
+            self.pool = ThreadPoolExecutor(
+                max_workers=app.config['JOB_MAX_WORKERS']
+            )
+        # the branches of the workflows run in a separate pool: a branch
+        # waits for the devices of its job, processed by the shared pool.
+        if not self.branches:
+            max_branches = app.config['WORKFLOW_MAX_BRANCHES']
+            self.branches = ThreadPoolExecutor(max_workers=max_branches)
+            self.branch_slots = BoundedSemaphore(max_branches)
+
+    @property
+    def in_worker(self):
+        return getattr(self.context, 'in_worker', False)
+
+    def bind(self, function):
+        # a function run in another thread on behalf of a job (a step of a
+        # workflow) keeps its context: if the job runs in a worker of the
+        # pool, so does the function.
+        in_worker = self.in_worker
+
+        def bound(*args):
+            if in_worker:
+                return self.execute(function, *args)
+            return function(*args)
+        return bound
+
+    def submit_branch(self, function, *args, inline=False):
+        # a branch only gets a thread if one is free (otherwise, or if
+        # "inline" is set, it runs in the calling thread): a workflow never
+        # waits for a thread held by another workflow, even its own parent.
+        if inline or not self.branch_slots.acquire(blocking=False):
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+
+        def branch():
+            try:
+                return function(*args)
+            finally:
+                self.branch_slots.release()
+        return self.branches.submit(copy_context().run, branch)
+
+    def execute(self, function, *args):
+        self.context.in_worker = True
+        try:
+            return function(*args)
+        finally:
+            self.context.in_worker = False
+
+    def map(
+        self,
+        function,
+        targets,
+        max_workers,
+        timeout=0,
+        callback=None,
+        stop=None,
+        retry=None,
+        inline=False
+    ):
+        # "callback" is called with each target and its results as soon as
+        # they are available, from the thread that called "map".
+        # "stop" is checked at least every second: when it returns a reason,
+        # the remaining targets are skipped and "map" stops waiting for the
+        # targets being processed.
+        # "retry" returns the delay before the next attempt of a failed
+        # target (None if it must not be retried): failed targets are put
+        # back in the queue, and no thread waits for their delay to expire.
+        # "timeout" does not interrupt the thread processing a device (only
+        # the service can, e.g. with the timeouts of netmiko and napalm): a
+        # target that timed out still counts against "max_workers" until
+        # its thread ends, and it is retried only once its previous attempt
+        # is over, so that a device is never processed twice at once.
+        results, start_times, running, hung = {}, {}, {}, {}
+        attempts, delayed, counter = Counter(), [], count()
+        pending = deque(targets)
+
+        def next_target():
+            if delayed and delayed[0][0] <= time():
+                return heappop(delayed)[2]
+            return pending.popleft() if pending else None
+
+        def add_result(target, result, final=False):
+            attempts[target] += 1
+            delay = None if final else retry_delay(
+                retry,
+                result,
+                attempts[target]
+            )
+            if delay is not None and not (stop and stop()):
+                heappush(delayed, (time() + delay, next(counter), target))
+                return
+            if attempts[target] > 1:
+                result = dict(result, attempts=attempts[target])
+            results[target] = result
+            if callback:
+                callback(target, result)
+
+        def stop_all(reason):
+            for future, target in running.items():
+                future.cancel()
+                add_result(target, failure(reason))
+            for target, result, _ in hung.values():
+                if result:
+                    add_result(target, failure(reason))
+            for *_, target in delayed:
+                add_result(target, failure(reason))
+            for target in pending:
+                add_result(target, failure(reason))
+            return results
+
+        # a job started from a worker thread (a service inside a
+        # multiprocessing workflow) runs inline: waiting for the shared
+        # pool from one of its own threads could deadlock it. Its failed
+        # targets are not retried: waiting for the delay would hold the
+        # worker.
+        if self.in_worker:
+            retry = None
+        if inline or self.in_worker or not self.pool:
+            while True:
+                reason = stop and stop()
+                if reason:
+                    return stop_all(reason)
+                target = next_target()
+                if target is not None:
+                    add_result(target, function(target))
+                elif delayed:
+                    sleep(min(max(delayed[0][0] - time(), 0), 1))
+                else:
+                    return results
+        max_workers = max(max_workers or 1, 1)
+
+        def process(target):
+            start_times[target] = time()
+            return function(target)
+
+        while True:
+            reason = stop and stop()
+            if reason:
+                return stop_all(reason)
+            while len(running) + len(hung) < max_workers:
+                target = next_target()
+                if target is None:
+                    break
+                start_times.pop(target, None)
+                # the target is processed in the context of the caller
+                # (e.g. the run of the job, see progress.py)
+                future = self.pool.submit(
+                    copy_context().run,
+                    self.execute,
+                    process,
+                    target
+                )
+                running[future] = target
+            # a target is not retried if its previous attempt is still hung
+            # "timeout" seconds after it timed out
+            for future, (target, result, deadline) in list(hung.items()):
+                if result and time() > deadline:
+                    add_result(target, result, final=True)
+                    hung[future] = (target, None, None)
+            retries = [deadline for *_, deadline in hung.values() if deadline]
+            if not running and not delayed and not pending and not retries:
+                return results
+            # wake up to check stops (every second), when the next device
+            # times out, and when the next failed target can be retried
+            wake_up = [1] if timeout or stop else []
+            if delayed:
+                wake_up.append(max(delayed[0][0] - time(), 0))
+            if retries:
+                wake_up.append(max(min(retries) - time(), 0))
+            started = [
+                start_times[target] for target in running.values()
+                if target in start_times
+            ]
+            if timeout and len(started) < len(running):
+                wake_up.append(timeout)
+            elif timeout and started:
+                wake_up.append(max(min(started) + timeout - time(), 0))
+            if not running and not hung:
+                sleep(min(wake_up))
+                continue
+            done, _ = wait(
+                set(running) | set(hung),
+                timeout=min(wake_up) if wake_up else None,
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future in running:
+                    add_result(running.pop(future), future.result())
+                    continue
+                target, result, _ = hung.pop(future)
+                if result:
+                    add_result(target, result)
+            if not timeout:
+                continue
+            # the timeout applies from the moment a worker picks up the
+            # device, not from the moment it is queued in the shared pool.
+            now = time()
+            for future, target in list(running.items()):
+                if now - start_times.get(target, now) <= timeout:
+                    continue
+                running.pop(future)
+                if future.done():
+                    add_result(target, future.result())
+                    continue
+                result = failure(f'Timeout after {timeout} seconds')
+                # if the target is to be retried, its result is added (and
+                # its retry scheduled) when the attempt is over
+                if retry_delay(retry, result, attempts[target] + 1) is None:
+                    add_result(target, result)
+                    hung[future] = (target, None, None)
+                else:
+                    hung[future] = (target, result, now + timeout)
+
+    def run_coroutine(self, coroutine):
+        # each call gets its own event loop, so that asynchronous jobs can
+        # be started from any thread (scheduler, REST API, pool workers).
+        loop = new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    async def run_in_thread(self, function, *args):
+        # adapter for blocking code (netmiko, napalm, requests) called from
+        # an asynchronous job: it runs in the shared pool and does not
+        # block the event loop.
+        # the function runs in the context of the caller (e.g. the sessions
+        # it opens belong to the call of the job, see connections.py)
+        context = copy_context()
+        future = self.pool.submit(context.run, self.execute, function, *args)
+        threads = self.threads.get()
+        if threads is not None:
+            threads.append(future)
+        call = wrap_future(future)
+        # a job run by a worker of the pool must not wait for a thread of
+        # the pool forever (all threads could be waiting the same way): a
+        # call that is not picked up quickly is run by the worker itself.
+        if self.in_worker:
+            await async_wait([call], timeout=self.pickup_timeout)
+            if future.cancel():
+                return context.run(function, *args)
+        return await call
+
+    def map_async(
+        self,
+        function,
+        targets,
+        max_workers,
+        timeout=0,
+        callback=None,
+        stop=None,
+        retry=None
+    ):
+        async def attempt(target, semaphore):
+            async with semaphore:
+                reason = stop and stop()
+                if reason:
+                    return failure(reason)
+                try:
+                    return await wait_for(function(target), timeout or None)
+                except AsyncTimeoutError:
+                    return failure(f'Timeout after {timeout} seconds')
+
+        async def hung_threads(threads):
+            # a thread cannot be cancelled: after a timeout, the threads of
+            # the attempt may still be running. They are given "timeout"
+            # seconds to finish.
+            running = [wrap_future(thread) for thread in threads
+                       if not thread.done()]
+            threads.clear()
+            if running:
+                _, running = await async_wait(running, timeout=timeout or None)
+            return running
+
+        async def process(target, semaphore):
+            # the semaphore is released while a failed target waits for
+            # its next attempt
+            threads = []
+            self.threads.set(threads)
+            try:
+                for number in count(1):
+                    result = await attempt(target, semaphore)
+                    delay = retry_delay(retry, result, number)
+                    if delay is None or stop and stop():
+                        break
+                    await async_sleep(delay)
+                    # a device is never processed twice at once: it is not
+                    # retried while its previous attempt is still running
+                    if await hung_threads(threads):
+                        break
+            except CancelledError:
+                result = failure(stop() or 'Cancelled')
+            if number > 1:
+                result = dict(result, attempts=number)
+            if callback:
+                callback(target, result)
+            return target, result
+
+        async def process_all():
+            semaphore = Semaphore(max(max_workers or 1, 1))
+            tasks = [
+                ensure_future(process(target, semaphore))
+                for target in targets
+            ]
+            pending = set(tasks)
+            # unlike threads, coroutines are cancelled as soon as the job
+            # stops (at the next "await" of the device being processed)
+            while pending:
+                _, pending = await async_wait(
+                    pending,
+                    timeout=1 if stop else None
+                )
+                if pending and stop and stop():
+                    for task in pending:
+                        task.cancel()
+                    await async_wait(pending)
+                    break
+            return [task.result() for task in tasks]
+        return dict(self.run_coroutine(process_all()))
+
+
+executor = JobExecutor()
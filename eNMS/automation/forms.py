@@ -21,6 +21,18 @@ class JobForm(FlaskForm):
         'Time between retries (in seconds)',
         default=10
     )
+    max_processes = IntegerField(
+        'Maximum number of devices processed in parallel',
+        default=50
+    )
+    device_timeout = IntegerField(
+        'Timeout per device (in seconds, 0 for no timeout)',
+        default=0
+    )
+    max_runtime = IntegerField(
+        'Maximum runtime (in seconds, 0 for no limit)',
+        default=0
+    )
     vendor = TextField()
     operating_system = TextField()
 
@@ -1,11 +1,14 @@
+from ast import Attribute, Load, Name, parse, walk
+from functools import lru_cache
 from logging import info
 from napalm import get_network_driver
 from napalm._SUPPORTED_DRIVERS import SUPPORTED_DRIVERS
 from netmiko import ConnectHandler
 from netmiko.ssh_dispatcher import CLASS_MAPPER, FILE_TRANSFER_MAP
-from re import compile
+from re import split
 
 from eNMS import db, scheduler
+from eNMS.automation.connections import connection_pool
 from eNMS.automation.models import Job
 from eNMS.base.helpers import get_device_credentials, fetch
 
@@ -19,41 +22,123 @@ NETMIKO_SCP_DRIVERS = sorted((driver, driver) for driver in FILE_TRANSFER_MAP)
 # we exclude "base" from supported drivers
 NAPALM_DRIVERS = sorted((driver, driver) for driver in SUPPORTED_DRIVERS[1:])
 
+# builtins that can be used in a variable substitution
+TEMPLATE_BUILTINS = {
+    function.__name__: function for function in (
+        abs, all, any, bool, dict, enumerate, float, format, int, len, list,
+        max, min, range, repr, round, sorted, str, sum, tuple, zip
+    )
+}
+
+# attributes that cannot be used in a variable substitution: the format
+# methods of strings can read any attribute ("{0.__class__}"), and the
+# query of a model gives access to the database
+TEMPLATE_FORBIDDEN_ATTRIBUTES = {'format', 'format_map', 'query', 'session'}
+
 
 def netmiko_connection(service, device):
-    username, pwd, enable_pwd = get_device_credentials(scheduler.app, device)
-    return ConnectHandler(
-        device_type=service.driver,
-        ip=device.ip_address,
-        username=username,
-        password=pwd,
-        secret=enable_pwd,
-        fast_cli=service.fast_cli
+    def open_connection():
+        username, pwd, enable_pwd = get_device_credentials(
+            scheduler.app,
+            device
+        )
+        return ConnectHandler(
+            device_type=service.driver,
+            ip=device.ip_address,
+            username=username,
+            password=pwd,
+            secret=enable_pwd,
+            fast_cli=service.fast_cli
+        )
+    return connection_pool.connect(
+        ('netmiko', device.id, service.driver, service.fast_cli),
+        device.id,
+        open_connection,
+        lambda connection: connection.is_alive(),
+        lambda connection: connection.disconnect()
     )
 
 
 def napalm_connection(service, device):
-    optional_args = service.optional_args
-    if not optional_args:
-        optional_args = {}
-    username, pwd, enable_pwd = get_device_credentials(scheduler.app, device)
-    if 'secret' not in optional_args:
-        optional_args['secret'] = enable_pwd
-    driver = get_network_driver(service.driver)
-    return driver(
-        hostname=device.ip_address,
-        username=username,
-        password=pwd,
-        optional_args=optional_args
+    optional_args = dict(service.optional_args or {})
+
+    def open_connection():
+        username, pwd, enable_pwd = get_device_credentials(
+            scheduler.app,
+            device
+        )
+        if 'secret' not in optional_args:
+            optional_args['secret'] = enable_pwd
+        driver = get_network_driver(service.driver)(
+            hostname=device.ip_address,
+            username=username,
+            password=pwd,
+            optional_args=optional_args
+        )
+        driver.open()
+        return driver
+    options = str(sorted(optional_args.items()))
+    return connection_pool.connect(
+        ('napalm', device.id, service.driver, options),
+        device.id,
+        open_connection,
+        lambda connection: connection.is_alive()['is_alive'],
+        lambda connection: connection.close()
     )
 
 
-def substitute(data, variables):
-    r = compile('{{(.*?)}}')
+def release_connection(connection):
+    # the session is kept open for the next service of the workflow run
+    # if connections are pooled, and closed otherwise
+    connection_pool.release(connection)
 
-    def replace_with_locals(match):
-        return str(eval(match.group()[2:-2], variables))
-    return r.sub(replace_with_locals, data)
+
+@lru_cache(maxsize=1024)
+def compile_template(data):
+    # a template is compiled once into a list of strings (the text between
+    # two variables) and code objects (the variables, with the names they
+    # read), and cached: it is compiled again only when the text of the
+    # service changes.
+    # these checks prevent mistakes, they do not make it safe to run the
+    # template of an untrusted user: it is not a sandbox.
+    template = []
+    for index, part in enumerate(split('{{(.*?)}}', data)):
+        if not index % 2:
+            if part:
+                template.append(part)
+            continue
+        expression = parse(part.strip(), mode='eval')
+        loaded, stored = set(), set()
+        for node in walk(expression):
+            if isinstance(node, Attribute) and (
+                node.attr.startswith('_')
+                or node.attr in TEMPLATE_FORBIDDEN_ATTRIBUTES
+            ) or isinstance(node, Name) and node.id.startswith('_'):
+                raise ValueError(f'Forbidden variable in template: {part}')
+            if isinstance(node, Name):
+                (loaded if isinstance(node.ctx, Load) else stored).add(node.id)
+        code = compile(expression, '<template>', 'eval')
+        # the variables of comprehensions are not read from the namespace
+        template.append((code, frozenset(loaded - stored)))
+    return tuple(template)
+
+
+def substitute(data, variables):
+    if '{{' not in data:
+        return data
+    namespace, result = {**variables, '__builtins__': TEMPLATE_BUILTINS}, []
+    for part in compile_template(data):
+        if isinstance(part, str):
+            result.append(part)
+            continue
+        code, names = part
+        # only the variables of the service and the template builtins
+        # can be used
+        unknown = names - set(variables) - set(TEMPLATE_BUILTINS)
+        if unknown:
+            raise ValueError(f'Unknown variable in template: {min(unknown)}')
+        result.append(str(eval(code, namespace)))
+    return ''.join(result)
 
 
 def scheduler_job(job_id):
@@ -1,21 +1,60 @@
+from asyncio import iscoroutinefunction
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, wait
 from datetime import datetime
-from multiprocessing.pool import ThreadPool
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, PickleType, String
+from flask import has_app_context
+from functools import partial
+from heapq import heappop, heappush
+from itertools import chain, count
+from json import dumps, loads
+from random import uniform
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    PickleType,
+    select,
+    String
+)
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import backref, relationship
-from time import sleep
+from sqlalchemy.orm import (
+    backref,
+    deferred,
+    object_session,
+    relationship,
+    selectinload,
+    undefer
+)
+from threading import BoundedSemaphore, Lock, RLock
+from time import time
+from zlib import compress, decompress
 
-from eNMS import db
+from eNMS import db, scheduler
 from eNMS.base.associations import (
     job_device_table,
     job_log_rule_table,
     job_pool_table,
     job_workflow_table
 )
-from eNMS.base.helpers import fetch
+from eNMS.automation.connections import connection_pool
+from eNMS.automation.executor import executor, retry_delay
+from eNMS.automation.payload import Payload, payload_stores
+from eNMS.automation.progress import job_progress
+from eNMS.automation.targets import device_updates, resolve_targets
+from eNMS.base.helpers import fetch, prefetch_device_credentials
 from eNMS.base.custom_base import CustomBase
 from eNMS.base.properties import cls_to_properties
 
+# the jobs of a workflow are loaded in the session of the thread that runs
+# it, and used by its branches from other threads (the session of a job is
+# the session it was loaded in, see Job.session): the lazy loads, queries
+# and commits of a shared session must not run at the same time.
+session_lock = RLock()
+
 
 class Job(CustomBase):
 
@@ -27,8 +66,17 @@ class Job(CustomBase):
     description = Column(String)
     number_of_retries = Column(Integer, default=0)
     time_between_retries = Column(Integer, default=10)
+    max_processes = Column(Integer, default=50)
+    device_timeout = Column(Integer, default=0)
+    max_runtime = Column(Integer, default=0)
     positions = Column(MutableDict.as_mutable(PickleType), default={})
-    logs = Column(MutableDict.as_mutable(PickleType), default={})
+    runs = relationship(
+        'JobRun',
+        back_populates='job',
+        cascade='all, delete-orphan',
+        lazy='dynamic',
+        order_by='JobRun.runtime'
+    )
     state = Column(String, default='Idle')
     status = Column(MutableDict.as_mutable(PickleType), default={})
     tasks = relationship('Task', back_populates='job', cascade='all,delete')
@@ -62,68 +110,289 @@ class Job(CustomBase):
         'polymorphic_on': type
     }
 
-    def compute_targets(self):
-        targets = set(self.devices)
-        for pool in self.pools:
-            targets |= set(pool.devices)
-        return targets
-
-    def job_sources(self, workflow, type='all'):
-        return [
-            x.source for x in self.sources
-            if (type == 'all' or x.type == type) and x.workflow == workflow
-        ]
-
-    def job_successors(self, workflow, type='all'):
-        return [
-            x.destination for x in self.destinations
-            if (type == 'all' or x.type == type) and x.workflow == workflow
-        ]
+    @property
+    def session(self):
+        return object_session(self) or db.session
 
-    def try_run(self, payload=None, targets=None):
+    def compute_targets(self):
+        # the targets are read from the association tables: the changes of
+        # the session must be sent to the database first
+        with session_lock:
+            self.session.flush()
+            return resolve_targets(self.id, self.session)
+
+    def try_run(
+        self,
+        payload=None,
+        targets=None,
+        trigger=None,
+        parent=None,
+        runtime=None
+    ):
+        # the progress of the run is identified by the job and its runtime,
+        # unless another runtime is given (the runs of a job for each
+        # device of a multiprocessing workflow share the same progress)
         now = str(datetime.now())
-        for i in range(self.number_of_retries + 1):
+        run = (self.id, runtime or now)
+        job_progress.start(run, self.max_runtime, parent)
+        token = job_progress.current.set(run)
+        try:
             results = self.run(payload, targets)
-            self.logs[now] = results
-            if results['success']:
-                break
-            if i != self.number_of_retries:
-                sleep(self.time_between_retries)
+            reason = job_progress.stopped(run)
+            if reason:
+                results.update({'success': False, 'stopped': reason})
+        except Exception:
+            job_progress.finish(run, False)
+            raise
+        finally:
+            job_progress.current.reset(token)
+        job_progress.finish(run, results['success'])
+        run = JobRun(now, results, trigger)
+        with session_lock:
+            self.runs.append(run)
         return results
 
+    def retry_delay(self, attempt):
+        # exponential backoff with jitter: the delay doubles after each
+        # attempt, and is randomized so that the retries of all failed
+        # devices are spread out.
+        if attempt > self.number_of_retries:
+            return None
+        return self.time_between_retries * 2 ** (attempt - 1) * uniform(0.5, 1)
+
+    def get_run(self, runtime):
+        return self.runs.filter_by(runtime=runtime).options(
+            undefer(JobRun.payload),
+            selectinload(JobRun.device_results).undefer('payload')
+        ).first()
+
+    def run_history(self):
+        return {run.runtime: run.results for run in self.runs.options(
+            undefer(JobRun.payload),
+            selectinload(JobRun.device_results).undefer('payload')
+        )}
+
+    def runtimes(self):
+        return [runtime for runtime, in db.session.query(JobRun.runtime)
+                .filter_by(job_id=self.id).order_by(JobRun.runtime)]
+
+    def clear_runs(self):
+        run_ids = db.session.query(JobRun.id).filter_by(job_id=self.id)
+        JobRunDeviceResult.query.filter(
+            JobRunDeviceResult.run_id.in_(run_ids.subquery())
+        ).delete(synchronize_session=False)
+        JobRun.query.filter_by(job_id=self.id).delete(
+            synchronize_session=False
+        )
+
     def get_results(self, payload, device=None):
-        try:
-            return self.job(device, payload) if device else self.job(payload)
-        except Exception as e:
-            return {'success': False, 'result': str(e)}
+        if iscoroutinefunction(self.job):
+            return executor.run_coroutine(
+                self.get_async_results(payload, device)
+            )
+        # the sessions opened by the job for this call are released at the
+        # end of the call
+        stop = partial(job_progress.stopped, job_progress.current.get())
+        with connection_pool.checkout(stop):
+            try:
+                if device:
+                    return self.job(device, payload)
+                return self.job(payload)
+            except Exception as e:
+                return {'success': False, 'result': str(e)}
+
+    async def get_async_results(self, payload, device=None):
+        args = (device, payload) if device else (payload,)
+        stop = partial(job_progress.stopped, job_progress.current.get())
+        with connection_pool.checkout(stop):
+            try:
+                if iscoroutinefunction(self.job):
+                    return await self.job(*args)
+                return await executor.run_in_thread(self.job, *args)
+            except Exception as e:
+                return {'success': False, 'result': str(e)}
 
     def run(self, payload=None, targets=None):
-        results = {'success': True, 'devices': {}}
+        run = job_progress.current.get()
         if not targets:
             targets = self.compute_targets()
-        if self.multiprocessing:
-            pool = ThreadPool(processes=min(len(targets), 1))
-            pool.map(
-                self.device_run,
-                [(device, results, payload) for device in targets]
+        if not targets:
+            # a job without target (a workflow, or a service that does not
+            # run on devices) is retried as a whole, unless it runs in a
+            # worker of the shared pool (see executor.map)
+            retry = None if executor.in_worker else self.retry_delay
+            for attempt in count(1):
+                results = self.get_results(payload)
+                delay = retry_delay(retry, results, attempt)
+                if delay is None or job_progress.wait(run, delay):
+                    return results
+        results = {'success': True, 'devices': {}}
+        prefetch_device_credentials(scheduler.app, targets)
+        job_progress.add_targets(run, [device.name for device in targets])
+
+        # the results of each device are published as soon as they are
+        # available, for the progress of the run to be followed live.
+        def publish(device, device_result):
+            job_progress.publish(run, device.name, device_result)
+
+        # only the devices that failed are retried
+        options = {
+            'callback': publish,
+            'stop': partial(job_progress.stopped, run),
+            'retry': self.retry_delay
+        }
+        # asynchronous services ("async def job") run in an event loop,
+        # where the number of devices in flight is not bounded by the
+        # number of threads of the shared pool.
+        if self.multiprocessing and iscoroutinefunction(self.job):
+            device_results = executor.map_async(
+                partial(self.get_async_results, payload),
+                targets,
+                self.max_processes,
+                self.device_timeout,
+                **options
             )
-            pool.close()
-            pool.join()
         else:
-            if targets:
-                results['devices'] = {
-                    device.name: self.get_results(payload, device)
-                    for device in targets
-                }
-            else:
-                results = self.get_results(payload)
+            device_results = executor.map(
+                partial(self.get_results, payload),
+                targets,
+                self.max_processes,
+                self.device_timeout,
+                inline=not self.multiprocessing,
+                **options
+            )
+        # the changes made to the devices by the job are saved in one
+        # transaction
+        with session_lock:
+            device_updates.apply(self.id)
+        for device, device_result in device_results.items():
+            results['devices'][device.name] = device_result
+            if not device_result['success']:
+                results['success'] = False
         return results
 
-    def device_run(self, args):
-        device, results, payload = args
-        results['devices'][device.name] = self.get_results(payload, device)
-        if not results['devices'][device.name]['success']:
-            results['success'] = False
+
+def compress_results(results):
+    return compress(dumps(results, default=str).encode())
+
+
+def decompress_results(payload):
+    return loads(decompress(payload).decode()) if payload else {}
+
+
+class JobRun(CustomBase):
+
+    __tablename__ = 'JobRun'
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('Job.id'))
+    job = relationship('Job', back_populates='runs')
+    runtime = Column(String)
+    success = Column(Boolean)
+    trigger = Column(String)
+    # the results are compressed, and only loaded when they are read:
+    # the results of each device are stored in a separate row.
+    payload = deferred(Column(LargeBinary))
+    device_results = relationship(
+        'JobRunDeviceResult',
+        back_populates='run',
+        cascade='all, delete-orphan'
+    )
+
+    __table_args__ = (Index('ix_JobRun_job_id_runtime', 'job_id', 'runtime'),)
+
+    def __init__(self, runtime, results, trigger=None):
+        self.runtime, self.trigger = runtime, trigger
+        self.success = bool(results.get('success'))
+        results = dict(results)
+        devices = results.get('devices')
+        if isinstance(devices, dict):
+            results['devices'] = {}
+            self.device_results = [
+                JobRunDeviceResult(device, device_results)
+                for device, device_results in devices.items()
+            ]
+        self.payload = compress_results(results)
+
+    def __repr__(self):
+        return self.runtime
+
+    @property
+    def results(self):
+        results = decompress_results(self.payload)
+        if self.trigger:
+            results['trigger'] = self.trigger
+        if self.device_results:
+            results['devices'] = {
+                device_results.device_name: device_results.results
+                for device_results in self.device_results
+            }
+        return results
+
+
+class JobRunDeviceResult(CustomBase):
+
+    __tablename__ = 'JobRunDeviceResult'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('JobRun.id'), index=True)
+    run = relationship('JobRun', back_populates='device_results')
+    device_name = Column(String)
+    success = Column(Boolean)
+    payload = deferred(Column(LargeBinary))
+
+    def __init__(self, device_name, results):
+        self.device_name = device_name
+        self.success = bool(results.get('success'))
+        self.payload = compress_results(results)
+
+    def __repr__(self):
+        return self.device_name
+
+    @property
+    def results(self):
+        return decompress_results(self.payload)
+
+
+class JobRunCancellation(CustomBase):
+
+    __tablename__ = 'JobRunCancellation'
+
+    # a cancellation requested in a process that does not run the job (see
+    # progress.py): the runtime is not set to cancel all its current runs
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer)
+    runtime = Column(String)
+    requested = Column(Float)
+
+    def __init__(self, job_id, runtime):
+        self.job_id, self.runtime, self.requested = job_id, runtime, time()
+
+    def __repr__(self):
+        return f'{self.job_id} {self.runtime}'
+
+
+class RunCancellations(object):
+
+    def request(self, job_id, runtime):
+        # the requests are read by the processes at least every second
+        # while their runs are in progress: old requests are deleted.
+        JobRunCancellation.query.filter(
+            JobRunCancellation.requested < time() - job_progress.ttl
+        ).delete(synchronize_session=False)
+        db.session.add(JobRunCancellation(job_id, runtime))
+        db.session.commit()
+
+    def load(self):
+        # read in any thread of the process running the jobs, without
+        # session (and without application context)
+        table = JobRunCancellation.__table__
+        return db.get_engine(scheduler.app).execute(
+            select([table.c.job_id, table.c.runtime, table.c.requested])
+        ).fetchall()
+
+
+job_progress.cancellations = RunCancellations()
 
 
 class Service(Job):
@@ -209,6 +478,41 @@ class WorkflowEdge(CustomBase):
         return properties
 
 
+class Pipeline(object):
+
+    # the devices of a multiprocessing workflow go through its jobs like on
+    # an assembly line: each job processes at most "max_processes" devices
+    # at the same time, and a device moves to the next job as soon as it
+    # is done with the current one.
+    # the runs of a job for all devices share the same runtime, hence the
+    # same progress.
+    def __init__(self):
+        self.lock, self.slots, self.runtimes = Lock(), {}, {}
+
+    def slot(self, job):
+        with self.lock:
+            if job.id not in self.slots:
+                self.slots[job.id] = BoundedSemaphore(
+                    max(job.max_processes or 1, 1)
+                )
+            return self.slots[job.id]
+
+    def runtime(self, job):
+        with self.lock:
+            return self.runtimes.setdefault(job.id, str(datetime.now()))
+
+    def run(self, job, stop, *args, **kwargs):
+        slot = self.slot(job)
+        while not slot.acquire(timeout=1):
+            reason = stop()
+            if reason:
+                return {'success': False, 'result': reason}
+        try:
+            return job.try_run(*args, runtime=self.runtime(job), **kwargs)
+        finally:
+            slot.release()
+
+
 class Workflow(Job):
 
     __tablename__ = 'Workflow'
@@ -221,6 +525,10 @@ class Workflow(Job):
         back_populates='workflows'
     )
     edges = relationship('WorkflowEdge', back_populates='workflow')
+    # compiled graph of the workflow, used to run it: it is computed at the
+    # first run and reset when the graph is modified
+    plan = Column(PickleType)
+    pipeline = None
 
     __mapper_args__ = {
         'polymorphic_identity': 'workflow',
@@ -231,42 +539,245 @@ class Workflow(Job):
         self.jobs.extend(defaults)
         super().__init__(**kwargs)
 
+    def graph(self):
+        # the jobs and edges of the workflow are read from the database: a
+        # change is seen whatever the way it was made (workflow builder,
+        # REST API, other session, etc)
+        session = self.session
+        session.flush()
+        jobs = dict(session.query(Job.id, Job.name).filter(
+            Job.id == job_workflow_table.c.job_id,
+            job_workflow_table.c.workflow_id == self.id
+        ))
+        edges = session.query(
+            WorkflowEdge.id,
+            WorkflowEdge.type,
+            WorkflowEdge.source_id,
+            WorkflowEdge.destination_id
+        ).filter_by(workflow_id=self.id).order_by(WorkflowEdge.id)
+        return jobs, [tuple(edge) for edge in edges]
+
+    def compile_plan(self, jobs, edges):
+        successors = {job_id: {True: [], False: []} for job_id in jobs}
+        in_degree = dict.fromkeys(jobs, 0)
+        for _, type, source, destination in edges:
+            if source in successors and destination in in_degree:
+                successors[source][bool(type)].append(destination)
+                in_degree[destination] += 1
+        # "descendants" are the jobs that can be reached from a job
+        descendants = {}
+        for job_id in jobs:
+            reached, stack = set(), [job_id]
+            while stack:
+                for successor in sum(successors[stack.pop()].values(), []):
+                    if successor not in reached:
+                        reached.add(successor)
+                        stack.append(successor)
+            descendants[job_id] = sorted(reached)
+        names = {name: job_id for job_id, name in jobs.items()}
+        return {
+            'key': (sorted(jobs), edges),
+            'start': names['Start'],
+            'end': names['End'],
+            'successors': successors,
+            'in_degree': in_degree,
+            'descendants': descendants
+        }
+
+    def get_plan(self):
+        # the plan is compiled again when the jobs or the edges (ids, types
+        # and endpoints) of the workflow no longer match it
+        jobs, edges = self.graph()
+        if not self.plan or self.plan.get('key') != (sorted(jobs), edges):
+            self.plan = self.compile_plan(jobs, edges)
+        return self.plan
+
+    def run(self, payload=None, targets=None):
+        if not self.multiprocessing:
+            return super().run(payload, targets)
+        self.pipeline = Pipeline()
+        try:
+            return super().run(payload, targets)
+        finally:
+            self.pipeline = None
+
     def job(self, *args):
         device, payload = args if len(args) == 2 else (None, args)
-        if not self.multiprocessing:
-            self.status = {'jobs': {}}
-            if device:
-                self.status['current_device'] = device.name
-            db.session.commit()
-        jobs, visited = [self.jobs[0]], set()
+        # the netmiko and napalm sessions opened by a job are reused by the
+        # next jobs of the workflow that target the same device
+        with connection_pool.scope():
+            return self.run_jobs(device, payload)
+
+    def run_jobs(self, device, payload):
+        # the workflow is a DAG: a job is ready when all its incoming edges
+        # are resolved (their source has run or was skipped), and it runs
+        # if at least one of them was followed; otherwise it is skipped,
+        # and so are the edges that start from it. Independent branches
+        # run at the same time.
+        with session_lock:
+            plan = self.get_plan()
+            # the columns of the job subclasses are loaded here: they would
+            # otherwise be lazy loaded by the branches, outside the lock
+            jobs = {
+                job.id: job for job in self.session.query(Job)
+                .with_polymorphic('*')
+                .filter(Job.id.in_(plan['in_degree']))
+            }
+        successors, in_degree = plan['successors'], plan['in_degree']
+        descendants = {
+            job_id: set(reached)
+            for job_id, reached in plan['descendants'].items()
+        }
+        start, end = jobs[plan['start']], jobs[plan['end']]
+        resolved, followed, ready_at = Counter(), Counter(), {}
+        # jobs ready to run, ordered by the time they can start at (after
+        # the waiting time of their predecessors)
+        ready, counter, running, visited = [(0, 0, start)], count(1), {}, set()
         results = {'success': True}
-        while jobs:
-            job = jobs.pop()
-            # We check that all predecessors of the job have been visited
-            # to ensure that the job will receive the full payload.
-            # If it isn't the case, we put it back in the heap and move on to
-            # another job.
-            if any(n not in visited for n in job.job_sources(self)):
-                continue
-            visited.add(job)
-            if not self.multiprocessing:
-                self.status['current_job'] = job.serialized
-                db.session.commit()
-            job_results = job.try_run(results, {device} if device else None)
-            success = job_results['success']
-            if not self.multiprocessing:
-                self.status['jobs'][job.id] = success
-                db.session.commit()
-            if job == self.jobs[1]:
-                results['success'] = success
-            for successor in job.job_successors(self, success):
-                if successor not in visited:
-                    jobs.append(successor)
-            results[job.name] = job_results
-            sleep(job.waiting_time)
-        if not self.multiprocessing:
-            self.status['current_job'] = None
-            db.session.commit()
+        # the results of the jobs are published in the payload store, and
+        # a job reads the results of the jobs before it from the store.
+        # Results are released once all the jobs after their job have run
+        # or were skipped: only the results that can still be read are
+        # kept.
+        published, finished = {}, set()
+        run = job_progress.current.get()
+        stop = partial(job_progress.stopped, run)
+        status, flushed = {'jobs': {}}, [time()]
+        if device:
+            status['current_device'] = device.name
+
+        def update_status(flush=False, current=()):
+            # the status is published in memory at each step, for the
+            # workflow builder, and saved in the database periodically
+            if self.multiprocessing:
+                return
+            snapshot = dict(status, jobs=dict(status['jobs']))
+            snapshot['current_jobs'] = [
+                {'id': job.id, 'name': job.name}
+                for job in chain(running.values(), current)
+            ]
+            job_progress.set_status(run, snapshot)
+            if flush or time() - flushed[0] >= job_progress.status_interval:
+                flushed[0], self.status = time(), snapshot
+                with session_lock:
+                    self.session.commit()
+
+        def release():
+            for name, job_id in list(published.items()):
+                if descendants[job_id] <= finished:
+                    store.release(name)
+                    del published[name]
+
+        def complete(job, success=None):
+            # "success" is None when the job was skipped
+            finished.add(job.id)
+            edges = successors[job.id]
+            for successor in edges[True] + edges[False]:
+                resolved[successor] += 1
+            if success is not None:
+                for successor in edges[bool(success)]:
+                    followed[successor] += 1
+                    ready_at[successor] = max(
+                        ready_at.get(successor, 0),
+                        time() + job.waiting_time
+                    )
+            for successor in dict.fromkeys(edges[True] + edges[False]):
+                if resolved[successor] != in_degree[successor]:
+                    continue
+                if followed[successor]:
+                    heappush(ready, (
+                        ready_at[successor],
+                        next(counter),
+                        jobs[successor]
+                    ))
+                else:
+                    complete(jobs[successor])
+
+        update_status()
+
+        def run_job(job, job_payload, targets):
+            # a branch pool thread needs an application context (the
+            # thread of the workflow has one, and its session must not be
+            # removed when a job is done)
+            if not has_app_context():
+                with scheduler.app.app_context():
+                    return run_job(job, job_payload, targets)
+            if device and self.pipeline:
+                return self.pipeline.run(
+                    job,
+                    stop,
+                    job_payload,
+                    targets,
+                    parent=run
+                )
+            return job.try_run(job_payload, targets, parent=run)
+
+        with payload_stores.open() as store:
+            while ready or running:
+                if stop():
+                    results['success'] = False
+                    ready.clear()
+                started = ready and ready[0][0] <= time()
+                while ready and ready[0][0] <= time():
+                    job = heappop(ready)[2]
+                    if job in visited:
+                        continue
+                    visited.add(job)
+                    with session_lock:
+                        targets = device and {device} or job.compute_targets()
+                    # a job can only read the results of the jobs before it
+                    job_payload = Payload(store, [
+                        name for name, job_id in published.items()
+                        if job.id in descendants[job_id]
+                    ], {'success': results['success']})
+                    # a job runs in the thread of the workflow when it is
+                    # the only one to run, and in a thread of the branch
+                    # pool when other jobs can run at the same time.
+                    inline = not running and not ready
+                    if inline:
+                        update_status(current=[job])
+                    future = executor.submit_branch(
+                        executor.bind(run_job),
+                        job,
+                        job_payload,
+                        targets,
+                        inline=inline
+                    )
+                    running[future] = job
+                if started:
+                    update_status()
+                # wake up at least every second to check whether the
+                # workflow was stopped, and when the next job is ready
+                timeout = min(1, max(ready[0][0] - time(), 0)) if ready else 1
+                if not running:
+                    job_progress.wait(run, timeout)
+                    continue
+                done, _ = wait(
+                    running,
+                    timeout=timeout,
+                    return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    job = running.pop(future)
+                    job_results = future.result()
+                    success = job_results['success']
+                    published[job.name] = job.id
+                    # the results are only kept in the store (and in the
+                    # logs of the job): the results of the workflow refer
+                    # to them, so that they are not held twice in memory.
+                    store.put(job.name, job_results)
+                    results[job.name] = {
+                        'success': success,
+                        'result': f'See the logs of "{job.name}"'
+                    }
+                    if job == end:
+                        results['success'] = success
+                    status['jobs'][job.id] = success
+                    complete(job, success)
+                if done:
+                    release()
+                    update_status()
+        update_status(flush=True)
         return results
 
     @property
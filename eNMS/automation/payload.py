@@ -0,0 +1,101 @@
+from collections.abc import Mapping
+from itertools import chain
+from json import dumps, loads
+from os import remove
+from tempfile import mkstemp
+from threading import Lock
+from zlib import compress, decompress
+
+
+class PayloadStore(object):
+
+    # the results of the jobs of a workflow run, read by the next jobs.
+    # Results are stored as JSON (serialized once, which also gives their
+    # size): all jobs read the same kind of data, a copy that they can
+    # modify. Results larger than the threshold are written to disk, and
+    # only loaded when a job reads them.
+    def __init__(self, threshold, path=None):
+        self.threshold, self.path = threshold, path
+        self.lock, self.results, self.files = Lock(), {}, {}
+
+    def put(self, name, results):
+        data = dumps(results, default=str)
+        if len(data) <= self.threshold:
+            with self.lock:
+                self.results[name] = data
+            return False
+        descriptor, path = mkstemp(
+            prefix='payload-',
+            suffix='.json.z',
+            dir=self.path
+        )
+        with open(descriptor, 'wb') as file:
+            file.write(compress(data.encode()))
+        with self.lock:
+            self.files[name] = path
+        return True
+
+    def get(self, name):
+        with self.lock:
+            if name in self.results:
+                return loads(self.results[name])
+            path = self.files[name]
+        with open(path, 'rb') as file:
+            return loads(decompress(file.read()).decode())
+
+    def release(self, name):
+        with self.lock:
+            self.results.pop(name, None)
+            path = self.files.pop(name, None)
+        if path:
+            try:
+                remove(path)
+            except OSError:
+                pass
+
+    def close(self):
+        for name in list(chain(self.results, self.files)):
+            self.release(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+class Payload(Mapping):
+
+    # read-only payload of a job: the results of its predecessors are
+    # loaded from the store when (and each time) they are read.
+    def __init__(self, store, names, data):
+        self.store, self.names, self.data = store, names, data
+
+    def __getitem__(self, key):
+        if key in self.data:
+            return self.data[key]
+        if key in self.names:
+            return self.store.get(key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return chain(self.data, (n for n in self.names if n not in self.data))
+
+    def __len__(self):
+        return len(set(self.data) | set(self.names))
+
+
+class PayloadStores(object):
+
+    def __init__(self):
+        self.threshold, self.path = 1048576, None
+
+    def init_app(self, app):
+        self.threshold = app.config['PAYLOAD_SPILL_THRESHOLD']
+        self.path = app.config['PAYLOAD_SPILL_PATH']
+
+    def open(self):
+        return PayloadStore(self.threshold, self.path)
+
+
+payload_stores = PayloadStores()
@@ -0,0 +1,251 @@
+from collections import deque
+from contextvars import ContextVar
+from itertools import islice
+from logging import error
+from threading import Condition
+from time import time
+
+
+class RunProgress(object):
+
+    def __init__(self, runtime, deadline=None, parent=None, max_results=None):
+        self.runtime = runtime
+        # only the last results are kept: "published" is the total number
+        # of results, and the offset of the next one.
+        self.results, self.published = deque(maxlen=max_results), 0
+        self.pending, self.status = set(), {}
+        self.done = self.failed = 0
+        self.finished, self.success, self.end = False, None, None
+        self.deadline, self.parent = deadline, parent
+        self.cancelled, self.runners = False, 1
+        self.start = time()
+
+
+class JobProgress(object):
+
+    def __init__(self):
+        self.condition = Condition()
+        # the progress of a run is identified by its job and its runtime:
+        # "latest" is the runtime of the last run of each job.
+        self.runs, self.latest = {}, {}
+        # run of the job being executed (set by Job.try_run)
+        self.current = ContextVar('run', default=None)
+        self.ttl, self.max_timeout, self.max_results = 300, 30, 10000
+        self.status_interval = 10
+        # the progress of a run is only in the memory of the process that
+        # runs it, but a run can be cancelled from any process: the
+        # cancellations of the runs that are not in this process are stored
+        # in the database ("cancellations", see automation/models.py), and
+        # read by all processes every "cancel_interval" seconds.
+        self.cancellations = None
+        self.cancel_interval, self.cancel_checked = 1, 0
+
+    def init_app(self, app):
+        self.ttl = app.config['JOB_PROGRESS_TTL']
+        self.max_timeout = app.config['JOB_PROGRESS_MAX_TIMEOUT']
+        self.max_results = app.config['JOB_PROGRESS_MAX_RESULTS']
+        self.status_interval = app.config['WORKFLOW_STATUS_INTERVAL']
+
+    def find(self, job_id, runtime=None):
+        # the run of the job with this runtime, or its last run in this
+        # process (no runtime: a run of the job in another process)
+        return job_id, runtime or self.latest.get(job_id)
+
+    def start(self, run, max_runtime=0, parent=None):
+        with self.condition:
+            self.sweep()
+            progress = self.runs.get(run)
+            # a multiprocessing workflow runs a job once per device, with
+            # the same runtime: these runs share the same progress.
+            if progress:
+                progress.runners += 1
+                progress.finished = False
+                return
+            job_id, runtime = run
+            deadline = time() + max_runtime if max_runtime else None
+            self.runs[run] = RunProgress(
+                runtime,
+                deadline,
+                parent,
+                self.max_results
+            )
+            self.latest[job_id] = runtime
+            self.condition.notify_all()
+
+    def add_targets(self, run, devices):
+        with self.condition:
+            progress = self.runs.get(run)
+            if progress:
+                progress.pending |= set(devices)
+
+    def publish(self, run, device, results):
+        with self.condition:
+            progress = self.runs.get(run)
+            if not progress:
+                return
+            progress.pending.discard(device)
+            if results.get('success'):
+                progress.done += 1
+            else:
+                progress.failed += 1
+            progress.results.append({'device': device, 'results': results})
+            progress.published += 1
+            self.condition.notify_all()
+
+    def finish(self, run, success):
+        with self.condition:
+            progress = self.runs.get(run)
+            if not progress:
+                return
+            progress.runners -= 1
+            progress.success = success and progress.success is not False
+            if progress.runners:
+                return
+            progress.finished, progress.end = True, time()
+            self.condition.notify_all()
+
+    def set_status(self, run, status):
+        # the status of a workflow is replaced, never updated in place: it
+        # can be read without copy.
+        with self.condition:
+            progress = self.runs.get(run)
+            if progress:
+                progress.status = status
+
+    def get_status(self, run):
+        with self.condition:
+            progress = self.runs.get(run)
+            if not progress:
+                return None
+            return {
+                'state': 'Idle' if progress.finished else 'Running',
+                'status': progress.status
+            }
+
+    def cancel(self, run):
+        with self.condition:
+            progress = self.runs.get(run)
+            if progress:
+                if progress.finished:
+                    return False
+                progress.cancelled = True
+                self.condition.notify_all()
+                return True
+        # the run is not in this process: it may run in another one
+        if not self.cancellations:
+            return False
+        self.cancellations.request(*run)
+        return True
+
+    def check_cancellations(self):
+        now = time()
+        if (
+            not self.cancellations
+            or now - self.cancel_checked < self.cancel_interval
+        ):
+            return
+        self.cancel_checked = now
+        try:
+            requests = self.cancellations.load()
+        except Exception as exc:
+            error(f'Job progress: cancellations not read ({exc})')
+            return
+        with self.condition:
+            for job_id, runtime, requested in requests:
+                # without runtime, the runs of the job that were running
+                # when the cancellation was requested are cancelled
+                for (run_job_id, run_runtime), progress in self.runs.items():
+                    if (
+                        run_job_id != job_id
+                        or progress.finished
+                        or runtime and run_runtime != runtime
+                        or not runtime and progress.start > requested
+                    ):
+                        continue
+                    progress.cancelled = True
+                    self.condition.notify_all()
+
+    def stopped(self, run):
+        # a run stops when it is cancelled or when its maximum runtime is
+        # exceeded, and so does a job run by a workflow run that stops.
+        self.check_cancellations()
+        return self.run_stopped(run)
+
+    def run_stopped(self, run):
+        with self.condition:
+            progress, visited = self.runs.get(run), set()
+            while progress and run not in visited:
+                visited.add(run)
+                if progress.cancelled:
+                    return 'Cancelled'
+                if progress.deadline and time() > progress.deadline:
+                    return 'Maximum runtime exceeded'
+                run = progress.parent
+                progress = self.runs.get(run)
+            return None
+
+    def wait(self, run, seconds):
+        # interruptible sleep: returns early (with the reason) if the run
+        # stops. Deadlines are checked at least every second.
+        end = time() + seconds
+        while True:
+            self.check_cancellations()
+            with self.condition:
+                reason, remaining = self.run_stopped(run), end - time()
+                if reason or remaining <= 0:
+                    return reason
+                self.condition.wait(min(remaining, 1))
+
+    def poll(self, run, offset=0, timeout=0):
+        # long polling: wait until there are results after the offset, or
+        # until the run is over, for at most "timeout" seconds.
+        timeout = min(max(timeout, 0), self.max_timeout)
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.ready(run, offset),
+                timeout=timeout
+            )
+            progress = self.runs.get(run)
+            if not progress:
+                return None
+            # the results before the offset that are no longer kept are
+            # skipped
+            first = progress.published - len(progress.results)
+            results = list(islice(
+                progress.results,
+                max(offset - first, 0),
+                None
+            ))
+            return {
+                'runtime': progress.runtime,
+                'results': results,
+                'offset': progress.published,
+                'done': progress.done,
+                'failed': progress.failed,
+                'pending': len(progress.pending),
+                'finished': progress.finished,
+                'success': progress.success,
+                'cancelled': progress.cancelled
+            }
+
+    def ready(self, run, offset):
+        progress = self.runs.get(run)
+        return (
+            not progress
+            or progress.finished
+            or progress.published > offset
+        )
+
+    def sweep(self):
+        # the results of a finished run are kept for a while, so that a
+        # client can read the last results, then they are only in the
+        # run history.
+        now = time()
+        for (job_id, runtime), progress in list(self.runs.items()):
+            if progress.finished and now - progress.end > self.ttl:
+                del self.runs[job_id, runtime]
+                if self.latest.get(job_id) == runtime:
+                    del self.latest[job_id]
+
+
+job_progress = JobProgress()
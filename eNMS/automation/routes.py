@@ -23,6 +23,7 @@ from eNMS.automation.forms import (
     WorkflowForm
 )
 from eNMS.automation.helpers import scheduler_job
+from eNMS.automation.progress import job_progress
 from eNMS.automation.models import (
     Job,
     Service,
@@ -200,21 +201,37 @@ def save_service(cls_name):
 
 @post(bp, '/show_logs/<job_id>', 'Automation Section')
 def show_logs(job_id):
-    return jsonify(dumps(fetch(Job, id=job_id).logs, indent=4))
+    return jsonify(dumps(fetch(Job, id=job_id).run_history(), indent=4))
+
+
+@post(bp, '/cancel_job/<job_id>', 'Edit Automation Section')
+def cancel_job(job_id):
+    return jsonify(job_progress.cancel(
+        job_progress.find(int(job_id), request.form.get('runtime'))
+    ))
+
+
+@post(bp, '/job_progress/<job_id>', 'Automation Section')
+def get_job_progress(job_id):
+    return jsonify(job_progress.poll(
+        job_progress.find(int(job_id), request.form.get('runtime')),
+        int(request.form.get('offset', 0)),
+        float(request.form.get('timeout', 0))
+    ) or {})
 
 
 @post(bp, '/get_diff/<job_id>/<v1>/<v2>', 'Automation Section')
 def get_diff(job_id, v1, v2, n1=None, n2=None):
     job = fetch(Job, id=job_id)
-    first = str_dict(job.logs[v1]).splitlines()
-    second = str_dict(job.logs[v2]).splitlines()
+    first = str_dict(job.get_run(v1).results).splitlines()
+    second = str_dict(job.get_run(v2).results).splitlines()
     opcodes = SequenceMatcher(None, first, second).get_opcodes()
     return jsonify({'first': first, 'second': second, 'opcodes': opcodes})
 
 
 @post(bp, '/clear_logs/<job_id>', 'Edit Automation Section')
 def clear_logs(job_id):
-    fetch(Job, id=job_id).logs = {}
+    fetch(Job, id=job_id).clear_runs()
     db.session.commit()
     return jsonify(True)
 
@@ -223,7 +240,7 @@ def clear_logs(job_id):
 def compare_logs(job_id):
     job = fetch(Job, id=job_id)
     results = {
-        'versions': list(job.logs)
+        'versions': job.runtimes()
     }
     return jsonify(results)
 
@@ -243,9 +260,19 @@ def get_workflow(workflow_id):
     return jsonify(workflow.serialized if workflow else {})
 
 
+@post(bp, '/workflow_status/<workflow_id>', 'Automation Section')
+def get_workflow_status(workflow_id):
+    status = job_progress.get_status(job_progress.find(int(workflow_id)))
+    if not status:
+        workflow = fetch(Workflow, id=workflow_id)
+        status = {'state': workflow.state, 'status': workflow.status}
+    return jsonify(status)
+
+
 @post(bp, '/reset_workflow_logs/<workflow_id>', 'Edit Automation Section')
 def reset_workflow_logs(workflow_id):
     fetch(Workflow, id=workflow_id).status = {'state': 'Idle'}
+    job_progress.set_status(job_progress.find(int(workflow_id)), {})
     db.session.commit()
     return jsonify(True)
 
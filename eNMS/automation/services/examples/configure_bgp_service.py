@@ -1,6 +1,6 @@
 from sqlalchemy import Column, ForeignKey, Integer, String
 
-from eNMS.automation.helpers import napalm_connection
+from eNMS.automation.helpers import napalm_connection, release_connection
 from eNMS.automation.models import Service, service_classes
 
 
@@ -24,7 +24,6 @@ class ConfigureBgpService(Service):
 
     def job(self, device, payload):
         napalm_driver = napalm_connection(self, device)
-        napalm_driver.open()
         config = f'''
             ip vrf {self.vrf_name}
             rd {self.local_as}:235
@@ -46,7 +45,7 @@ class ConfigureBgpService(Service):
         config = '\n'.join(config.splitlines())
         getattr(napalm_driver, 'load_merge_candidate')(config=config)
         napalm_driver.commit_config()
-        napalm_driver.close()
+        release_connection(napalm_driver)
         return {'success': True, 'result': f'Config push ({config})'}
 
 
@@ -2,6 +2,7 @@ from sqlalchemy import Column, ForeignKey, Integer, PickleType
 from sqlalchemy.ext.mutable import MutableDict
 
 from eNMS.automation.models import Service, service_classes
+from eNMS.automation.targets import device_updates
 
 
 class UpdateInventoryService(Service):
@@ -9,6 +10,7 @@ class UpdateInventoryService(Service):
     __tablename__ = 'UpdateInventoryService'
 
     id = Column(Integer, ForeignKey('Service.id'), primary_key=True)
+    multiprocessing = True
     update_dictionnary = Column(MutableDict.as_mutable(PickleType), default={})
 
     __mapper_args__ = {
@@ -16,8 +18,8 @@ class UpdateInventoryService(Service):
     }
 
     def job(self, device, payload):
-        for property, value in self.update_dictionnary.items():
-            setattr(device, property, value)
+        # the device is updated when all devices have been processed
+        device_updates.add(self.id, device, self.update_dictionnary)
         return {'success': True, 'result': 'properties updated'}
 
 
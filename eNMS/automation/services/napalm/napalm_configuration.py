@@ -4,6 +4,7 @@ from sqlalchemy.ext.mutable import MutableDict
 from eNMS.automation.helpers import (
     napalm_connection,
     NAPALM_DRIVERS,
+    release_connection,
     substitute
 )
 from eNMS.automation.models import Service, service_classes
@@ -32,11 +33,10 @@ class NapalmConfigurationService(Service):
 
     def job(self, device, payload):
         napalm_driver = napalm_connection(self, device)
-        napalm_driver.open()
         config = '\n'.join(substitute(self.content, locals()).splitlines())
         getattr(napalm_driver, self.action)(config=config)
         napalm_driver.commit_config()
-        napalm_driver.close()
+        release_connection(napalm_driver)
         return {'success': True, 'result': f'Config push ({config})'}
 
 
@@ -5,6 +5,7 @@ from sqlalchemy.ext.mutable import MutableDict, MutableList
 from eNMS.automation.helpers import (
     napalm_connection,
     NAPALM_DRIVERS,
+    release_connection,
     substitute
 )
 from eNMS.automation.models import Service, service_classes
@@ -51,7 +52,6 @@ class NapalmGettersService(Service):
 
     def job(self, device, payload):
         napalm_driver, result = napalm_connection(self, device), {}
-        napalm_driver.open()
         for getter in self.getters:
             try:
                 result[getter] = getattr(napalm_driver, getter)()
@@ -62,7 +62,7 @@ class NapalmGettersService(Service):
             self.content_match_regex and search(match, output)
             or match in output and not self.content_match_regex
         )
-        napalm_driver.close()
+        release_connection(napalm_driver)
         return {'success': success, 'result': result}
 
 
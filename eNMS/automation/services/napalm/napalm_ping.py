@@ -1,7 +1,11 @@
 from sqlalchemy import Column, ForeignKey, Integer, PickleType, String
 from sqlalchemy.ext.mutable import MutableDict
 
-from eNMS.automation.helpers import napalm_connection, NAPALM_DRIVERS
+from eNMS.automation.helpers import (
+    napalm_connection,
+    NAPALM_DRIVERS,
+    release_connection
+)
 from eNMS.automation.models import Service, service_classes
 
 
@@ -27,7 +31,6 @@ class NapalmPingService(Service):
 
     def job(self, device, payload):
         napalm_driver = napalm_connection(self, device)
-        napalm_driver.open()
         ping = napalm_driver.ping(
             device.ip_address,
             source=self.source,
@@ -37,7 +40,7 @@ class NapalmPingService(Service):
             size=self.size or 100,
             count=self.count or 5
         )
-        napalm_driver.close()
+        release_connection(napalm_driver)
         return {'success': 'success' in ping, 'result': ping}
 
 
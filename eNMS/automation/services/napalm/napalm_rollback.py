@@ -1,7 +1,11 @@
 from sqlalchemy import Column, ForeignKey, Integer, PickleType, String
 from sqlalchemy.ext.mutable import MutableDict
 
-from eNMS.automation.helpers import napalm_connection, NAPALM_DRIVERS
+from eNMS.automation.helpers import (
+    napalm_connection,
+    NAPALM_DRIVERS,
+    release_connection
+)
 from eNMS.automation.models import Service, service_classes
 
 
@@ -21,9 +25,8 @@ class NapalmRollbackService(Service):
 
     def job(self, device, payload):
         napalm_driver = napalm_connection(self, device)
-        napalm_driver.open()
         napalm_driver.rollback()
-        napalm_driver.close()
+        release_connection(napalm_driver)
         return {'success': True, 'result': 'Rollback successful'}
 
 
@@ -1,7 +1,11 @@
 from sqlalchemy import Column, ForeignKey, Integer, PickleType, String
 from sqlalchemy.ext.mutable import MutableDict
 
-from eNMS.automation.helpers import napalm_connection, NAPALM_DRIVERS
+from eNMS.automation.helpers import (
+    napalm_connection,
+    NAPALM_DRIVERS,
+    release_connection
+)
 from eNMS.automation.models import Service, service_classes
 
 
@@ -25,7 +29,6 @@ class NapalmTracerouteService(Service):
 
     def job(self, device, payload):
         napalm_driver = napalm_connection(self, device)
-        napalm_driver.open()
         traceroute = napalm_driver.traceroute(
             device.ip_address,
             source=self.source,
@@ -33,7 +36,7 @@ class NapalmTracerouteService(Service):
             ttl=self.ttl or 255,
             timeout=self.timeout or 2
         )
-        napalm_driver.close()
+        release_connection(napalm_driver)
         return {'success': 'success' in traceroute, 'result': traceroute}
 
 
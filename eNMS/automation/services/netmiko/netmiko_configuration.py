@@ -3,6 +3,7 @@ from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String
 from eNMS.automation.helpers import (
     netmiko_connection,
     NETMIKO_DRIVERS,
+    release_connection,
     substitute
 )
 from eNMS.automation.models import Service, service_classes
@@ -33,7 +34,7 @@ class NetmikoConfigurationService(Service):
             netmiko_handler.enable()
         config = substitute(self.content, locals())
         netmiko_handler.send_config_set(config.splitlines())
-        netmiko_handler.disconnect()
+        release_connection(netmiko_handler)
         return {'success': True, 'result': f'configuration OK {config}'}
 
 
@@ -1,7 +1,11 @@
 from netmiko import file_transfer
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
 
-from eNMS.automation.helpers import netmiko_connection, NETMIKO_SCP_DRIVERS
+from eNMS.automation.helpers import (
+    netmiko_connection,
+    NETMIKO_SCP_DRIVERS,
+    release_connection
+)
 from eNMS.automation.models import Service, service_classes
 
 
@@ -38,7 +42,7 @@ class NetmikoFileTransferService(Service):
             disable_md5=self.disable_md5,
             inline_transfer=self.inline_transfer
         )
-        netmiko_handler.disconnect()
+        release_connection(netmiko_handler)
         return {'success': True, 'result': transfer_dict}
 
 
@@ -4,6 +4,7 @@ from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
 from eNMS.automation.helpers import (
     netmiko_connection,
     NETMIKO_DRIVERS,
+    release_connection,
     substitute
 )
 from eNMS.automation.models import Service, service_classes
@@ -34,7 +35,7 @@ class NetmikoValidationService(Service):
             self.content_match_regex and search(self.content_match, output)
             or self.content_match in output and not self.content_match_regex
         )
-        netmiko_handler.disconnect()
+        release_connection(netmiko_handler)
         return {
             'output': output,
             'expected': self.content_match,
@@ -6,6 +6,8 @@ diffview: false
 */
 
 let jobId;
+// runtime of the run followed in the logs window
+let runtime;
 
 /**
  * Show the logs modal for a job.
@@ -13,9 +15,73 @@ let jobId;
  */
 function showLogs(id) { // eslint-disable-line no-unused-vars
   jobId = id;
+  runtime = undefined;
   call(`/automation/show_logs/${id}`, function(logs) {
     $('#logs').text(logs.replace(/\\n/g, '\n'));
+    $('#progress-counters,#progress-results').empty();
+    $('#progress,#cancel-job').hide();
     $(`#show-logs-modal`).modal('show');
+    followProgress(id, 0);
+  });
+}
+
+/**
+ * Follow the progress of a running job (long polling).
+ * @param {id} id - Job id.
+ * @param {offset} offset - Number of device results already displayed.
+ */
+function followProgress(id, offset) {
+  // the modal is still opening when the first request is sent
+  if (id != jobId || offset && !$('#show-logs-modal').is(':visible')) {
+    return;
+  }
+  $.ajax({
+    type: 'POST',
+    url: `/automation/job_progress/${id}`,
+    data: {offset: offset, timeout: 20, runtime: runtime || ''},
+    success: function(progress) {
+      // nothing to follow if the job is not running
+      if (!progress || !progress.runtime || progress.finished && !offset) {
+        return;
+      }
+      // the next requests (and the cancellation) are for the same run
+      runtime = progress.runtime;
+      for (let i = 0; i < progress.results.length; i++) {
+        const result = progress.results[i];
+        $('#progress-results').append(
+          `${result.device}: ${JSON.stringify(result.results)}\n`
+        );
+      }
+      $('#progress-counters').text(
+        `Run ${progress.runtime} - done: ${progress.done}, ` +
+        `failed: ${progress.failed}, pending: ${progress.pending}` +
+        (progress.finished ? ' (finished)' : '')
+      );
+      $('#progress').show();
+      $('#cancel-job').toggle(!progress.finished && !progress.cancelled);
+      if (!progress.finished) {
+        followProgress(id, progress.offset);
+      }
+    },
+  });
+}
+
+/**
+ * Cancel the job whose logs are displayed.
+ */
+function cancelJob() { // eslint-disable-line no-unused-vars
+  $.ajax({
+    type: 'POST',
+    url: `/automation/cancel_job/${jobId}`,
+    data: {runtime: runtime || ''},
+    success: function(cancelled) {
+      if (cancelled) {
+        $('#cancel-job').hide();
+        alertify.notify('Job cancelled.', 'success', 5);
+      } else {
+        alertify.notify('The job is not running.', 'error', 5);
+      }
+    },
   });
 }
 
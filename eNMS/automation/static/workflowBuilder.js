@@ -351,16 +351,19 @@ function colorJob(id, color) {
  */
 function getWorkflowStatus() {
   if (workflow) {
-    call(`/automation/get/${workflow.id}`, function(wf) {
+    call(`/automation/workflow_status/${workflow.id}`, function(wf) {
       $('#state').text(`State: ${wf.state}.`);
       if (wf.status.current_device) {
         $('#current-device').text(
           `Current device: ${wf.status.current_device}.`
         );
       }
-      if (wf.status.current_job) {
-        colorJob(wf.status.current_job.id, '#89CFF0');
-        $('#current-job').text(`Current job: ${wf.status.current_job.name}.`);
+      const currentJobs = wf.status.current_jobs || [];
+      if (currentJobs.length) {
+        currentJobs.forEach((job) => colorJob(job.id, '#89CFF0'));
+        $('#current-job').text(
+          `Current jobs: ${currentJobs.map((job) => job.name).join(', ')}.`
+        );
       } else {
         $('#current-device,#current-job').empty();
       }
@@ -0,0 +1,95 @@
+from collections import defaultdict, namedtuple
+from sqlalchemy import select, union
+from threading import Lock
+
+from eNMS import db
+from eNMS.base.associations import (
+    job_device_table,
+    job_pool_table,
+    pool_device_table
+)
+from eNMS.base.properties import device_public_properties
+from eNMS.objects.models import Device
+
+# the properties of a device that a job can use: its public properties
+# (for variable substitution) and its credentials
+device_record_properties = ['id'] + device_public_properties + [
+    'username',
+    'password',
+    'enable_password'
+]
+
+
+class DeviceRecord(namedtuple('DeviceRecord', device_record_properties)):
+
+    # read-only copy of a device, loaded before a job starts: it can be
+    # used by any thread, without database session.
+    __slots__ = ()
+
+    def __repr__(self):
+        return self.name
+
+    @property
+    def properties(self):
+        return {
+            property: getattr(self, property)
+            for property in ['id'] + device_public_properties
+        }
+
+
+def target_ids(job_id):
+    # devices of the job, and devices of the pools of the job
+    return union(
+        select([job_device_table.c.device_id])
+        .where(job_device_table.c.job_id == job_id),
+        select([pool_device_table.c.device_id])
+        .select_from(job_pool_table.join(
+            pool_device_table,
+            job_pool_table.c.pool_id == pool_device_table.c.pool_id
+        ))
+        .where(job_pool_table.c.job_id == job_id)
+    )
+
+
+def resolve_targets(job_id, session=None):
+    # all targets are loaded with one query, with only the columns of the
+    # device records
+    columns = [getattr(Device, property) for property in DeviceRecord._fields]
+    return {
+        DeviceRecord(*row) for row in (session or db.session).query(*columns)
+        .filter(Device.id.in_(target_ids(job_id)))
+    }
+
+
+class DeviceUpdates(object):
+
+    # the changes made by a job to its target devices are queued by the
+    # worker threads, and written to the database in one transaction when
+    # all targets have been processed.
+    def __init__(self):
+        self.lock, self.updates = Lock(), defaultdict(list)
+
+    def add(self, job_id, device, properties):
+        with self.lock:
+            self.updates[job_id].append((device.id, dict(properties)))
+
+    def apply(self, job_id):
+        with self.lock:
+            updates = self.updates.pop(job_id, [])
+        if not updates:
+            return 0
+        devices = {
+            device.id: device for device in Device.query.filter(
+                Device.id.in_([device_id for device_id, _ in updates])
+            )
+        }
+        for device_id, properties in updates:
+            if device_id not in devices:
+                continue
+            for property, value in properties.items():
+                setattr(devices[device_id], property, value)
+        db.session.commit()
+        return len(updates)
+
+
+device_updates = DeviceUpdates()
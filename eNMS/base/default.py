@@ -10,6 +10,7 @@ from eNMS.admin.models import Parameters, User
 from eNMS.base.custom_base import factory
 from eNMS.base.helpers import integrity_rollback, fetch
 from eNMS.base.properties import property_types, boolean_properties
+from eNMS.logs.models import LogRule
 from eNMS.objects.models import Device, Pool
 from eNMS.objects.routes import process_kwargs
 from eNMS.automation.models import Job, service_classes, Workflow, WorkflowEdge
@@ -38,6 +39,11 @@ def create_service_classes():
                     Float: float,
                     PickleType: dict,
                 }.get(type(col.type), str)
+    # the execution parameters (retries, parallelism, timeouts) are columns
+    # of the Job table, common to all services
+    for col in (*Job.__table__.columns, *LogRule.__table__.columns):
+        if type(col.type) == Integer:
+            property_types[col.key] = int
 
 
 @integrity_rollback
@@ -1,11 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 from flask import abort, jsonify
 from flask_login import current_user, login_required
 from functools import wraps
 from sqlalchemy import Boolean, exc, Integer, String, Float
+from threading import Lock
+from time import time
 
 from eNMS import db
 
 
+# secrets read from the vault, with their expiry time
+vault_cache, vault_cache_lock = {}, Lock()
+# threads reading the secrets before a job starts, shared by all jobs
+vault_prefetch = {}
+
 sql_types = {
     'boolean': Boolean,
     'float': Float,
@@ -80,9 +88,59 @@ def allowed_file(name, allowed_extensions):
 def vault_helper(app, path, data=None):
     vault_path = f'secret/data/{path}'
     if not data:
-        return app.vault_client.read(vault_path)['data']['data']
+        # only the device credentials are cached: the passwords of the users
+        # are always read, so that a password changed through another
+        # process is checked at once.
+        cached = path.startswith('device/')
+        with vault_cache_lock:
+            expiry, secret = vault_cache.get(path, (0, None))
+        if cached and expiry > time():
+            return secret
+        secret = app.vault_client.read(vault_path)['data']['data']
+        if cached:
+            with vault_cache_lock:
+                ttl = app.config['VAULT_CACHE_TTL']
+                vault_cache[path] = (time() + ttl, secret)
+        return secret
     else:
         app.vault_client.write(vault_path, data=data)
+        invalidate_vault_cache(path)
+
+
+def invalidate_vault_cache(path=None):
+    with vault_cache_lock:
+        if path:
+            vault_cache.pop(path, None)
+        else:
+            vault_cache.clear()
+
+
+def prefetch_device_credentials(app, devices):
+    # all secrets are read in parallel before a job starts, instead of
+    # one after the other by the job itself
+    if not app.config['USE_VAULT']:
+        return
+
+    def read(device):
+        try:
+            vault_helper(app, f'device/{device.name}')
+        except Exception:
+            # the error is raised again, and reported, when the job reads
+            # the credentials of this device
+            pass
+    with vault_cache_lock:
+        missing = [
+            device for device in devices
+            if vault_cache.get(f'device/{device.name}', (0,))[0] <= time()
+        ]
+    if not missing:
+        return
+    with vault_cache_lock:
+        if 'pool' not in vault_prefetch:
+            vault_prefetch['pool'] = ThreadPoolExecutor(
+                max_workers=app.config['VAULT_PREFETCH_WORKERS']
+            )
+    list(vault_prefetch['pool'].map(read, missing))
 
 
 def get_device_credentials(app, device):
@@ -87,11 +87,13 @@ job_public_properties = [
     'type',
     'description',
     'state',
-    'logs',
     'positions',
     'waiting_time',
     'number_of_retries',
-    'time_between_retries'
+    'time_between_retries',
+    'max_processes',
+    'device_timeout',
+    'max_runtime'
 ]
 
 service_public_properties = job_public_properties
@@ -163,6 +165,7 @@ log_rule_public_properties = log_public_properties + [
     'name',
     'sourceregex',
     'contentregex',
+    'retention',
     'jobs'
 ]
 
@@ -197,7 +200,7 @@ cls_to_properties = {
     'Workflow': workflow_public_properties,
     'WorkflowEdge': workflow_edge_properties,
     'User': user_serialized_properties,
-    'Log': log_public_properties,
+    'Log': log_public_properties + ['received'],
     'LogRule': log_rule_public_properties,
     'Task': task_serialized_properties
 }
@@ -265,6 +268,7 @@ pretty_names = {
     'destination': 'Destination',
     'dest_file': 'Destination file',
     'device_multiprocessing': 'Device multiprocessing',
+    'device_timeout': 'Timeout per device',
     'direction': 'Direction',
     'driver': 'Driver',
     'email': 'Email',
@@ -276,6 +280,8 @@ pretty_names = {
     'inventory_from_selection': 'Inventory from selection',
     'ip_address': 'IP address',
     'longitude': 'Longitude',
+    'max_processes': 'Maximum number of devices processed in parallel',
+    'max_runtime': 'Maximum runtime',
     'latitude': 'Latitude',
     'location': 'Location',
     'model': 'Model',
@@ -287,7 +293,9 @@ pretty_names = {
     'permission': 'Permission',
     'port': 'Port',
     'positions': 'Positions',
+    'received': 'Received',
     'recurrent': 'Recurrent',
+    'retention': 'Retention',
     'enable_password': 'Enable password',
     'source': 'Source',
     'source_file': 'Source file',
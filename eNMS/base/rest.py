@@ -1,9 +1,11 @@
+from datetime import datetime
 from flask import current_app, jsonify, make_response, request
 from flask_restful import Api, Resource
 
 from eNMS import auth, db
 from eNMS.admin.models import User
 from eNMS.automation.models import Job
+from eNMS.automation.progress import job_progress
 from eNMS.base.classes import diagram_classes
 from eNMS.base.custom_base import factory
 from eNMS.base.helpers import get_user_credentials, fetch
@@ -24,10 +26,30 @@ def unauthorized():
 class RestAutomation(Resource):
     decorators = [auth.login_required]
 
+    def get(self, job_name):
+        job, runtime = fetch(Job, name=job_name), str(datetime.now())
+        results = job.try_run(trigger='REST API', runtime=runtime)
+        db.session.commit()
+        return {'job': job.serialized, 'runtime': runtime, 'results': results}
+
+    def delete(self, job_name):
+        # the runtime identifies the run to cancel (default: the last run)
+        job = fetch(Job, name=job_name)
+        return job_progress.cancel(
+            job_progress.find(job.id, request.args.get('runtime'))
+        )
+
+
+class RestJobProgress(Resource):
+    decorators = [auth.login_required]
+
     def get(self, job_name):
         job = fetch(Job, name=job_name)
-        results = job.run()
-        return {'job': job.serialized, 'results': results}
+        return job_progress.poll(
+            job_progress.find(job.id, request.args.get('runtime')),
+            request.args.get('offset', 0, type=int),
+            request.args.get('timeout', 0, type=float)
+        )
 
 
 class GetInstance(Resource):
@@ -59,6 +81,10 @@ def configure_rest_api(app):
         RestAutomation,
         '/rest/run_job/<string:job_name>'
     )
+    api.add_resource(
+        RestJobProgress,
+        '/rest/job_progress/<string:job_name>'
+    )
     api.add_resource(
         UpdateInstance,
         '/rest/object/<string:cls_name>'
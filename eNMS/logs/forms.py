@@ -1,5 +1,11 @@
 from flask_wtf import FlaskForm
-from wtforms import BooleanField, HiddenField, SelectMultipleField, TextField
+from wtforms import (
+    BooleanField,
+    HiddenField,
+    IntegerField,
+    SelectMultipleField,
+    TextField
+)
 
 
 def configure_form(cls):
@@ -18,4 +24,5 @@ class LogFilteringForm(FlaskForm):
 class LogAutomationForm(LogFilteringForm):
     id = HiddenField()
     name = TextField()
+    retention = IntegerField(default=0)
     jobs = SelectMultipleField()
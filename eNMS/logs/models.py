@@ -1,23 +1,40 @@
-from re import search
-from sqlalchemy import Boolean, Column, Integer, String
+from collections import defaultdict, deque
+from datetime import datetime
+from itertools import islice
+from logging import error
+from re import compile, error as regex_error, escape, search
+from socket import SO_RCVBUF, SOL_SOCKET
+from sqlalchemy import (
+    Boolean,
+    Column,
+    event,
+    ForeignKey,
+    func,
+    Index,
+    Integer,
+    String,
+    text
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import and_, or_
 from sqlalchemy.orm import relationship
 from socketserver import BaseRequestHandler, UDPServer
-from threading import Thread
+from threading import Condition, Lock, Thread
+from time import time
 
 from eNMS import db, scheduler
+from eNMS.automation.models import Job
 from eNMS.base.associations import job_log_rule_table
 from eNMS.base.custom_base import CustomBase
+from eNMS.base.helpers import fetch
+from eNMS.objects.models import Device
 
 
 class SyslogUDPHandler(BaseRequestHandler):
 
     def handle(self):
-        with scheduler.app.app_context():
-            data = bytes.decode(self.request[0].strip())
-            source, _ = self.client_address
-            log = Log(source, str(data))
-            db.session.add(log)
-            db.session.commit()
+        source, _ = self.client_address
+        log_ingestion.enqueue(source, self.request[0])
 
 
 class SyslogServer(CustomBase):
@@ -39,6 +56,9 @@ class SyslogServer(CustomBase):
     def start(self):
         UDPServer.allow_reuse_address = True
         self.server = UDPServer((self.ip_address, self.port), SyslogUDPHandler)
+        # a larger socket buffer absorbs bursts of messages (the kernel caps
+        # it to net.core.rmem_max)
+        self.server.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 * 1024 * 1024)
         th = Thread(target=self.server.serve_forever)
         th.daemon = True
         th.start()
@@ -49,26 +69,187 @@ class Log(CustomBase):
     __tablename__ = 'Log'
 
     id = Column(Integer, primary_key=True)
-    source = Column(String)
+    source = Column(String, index=True)
     content = Column(String)
+    received = Column(String, index=True)
+    device_id = Column(Integer, ForeignKey('Device.id', ondelete='SET NULL'))
+
+    # the logs of a device are read from the most recent to the oldest
+    __table_args__ = (Index('ix_Log_device_id_id', 'device_id', 'id'),)
+
+    page_size, max_page_size = 100, 1000
 
-    def __init__(self, source, content):
+    def __init__(self, source, content, received=None):
         self.source = source
         self.content = content
-        for log_rule in LogRule.query.all():
-            trigger_jobs = all(
-                getattr(log_rule, prop) in getattr(self, prop)
-                if not getattr(log_rule, prop + 'regex')
-                else search(getattr(log_rule, prop), getattr(self, prop))
-                for prop in ('source', 'content') if getattr(log_rule, prop)
-            )
-            if trigger_jobs:
-                for job in log_rule.jobs:
-                    job.run()
+        self.received = received or str(datetime.now())
+        self.device_id = device_index.get(source)
+        job_triggers.trigger(
+            log_rule_matcher.match_jobs(source, content),
+            source
+        )
 
     def __repr__(self):
         return self.content
 
+    @classmethod
+    def search(cls, filters, cursor=None, limit=None):
+        # logs are returned from the most recent to the oldest, one page at
+        # a time: the cursor is the id of the last log of the previous page.
+        limit = min(int(limit or cls.page_size), cls.max_page_size)
+        query, regexes = cls.query, []
+        for property in ('source', 'content'):
+            value, column = filters.get(property), getattr(cls, property)
+            if not value:
+                continue
+            if not filters.get(f'{property}regex'):
+                query = query.filter(column.ilike(like_pattern(value), '\\'))
+            elif db.engine.dialect.name == 'postgresql':
+                query = query.filter(column.op('~')(value))
+            else:
+                regexes.append((property, compile(value)))
+        if filters.get('start'):
+            query = query.filter(cls.received >= filters['start'])
+        if filters.get('end'):
+            query = query.filter(cls.received <= filters['end'])
+        if cursor:
+            query = query.filter(cls.id < int(cursor))
+        query = query.order_by(cls.id.desc())
+        if regexes:
+            # without native regular expressions (SQLite), the logs are
+            # filtered in python until the page is full
+            logs = (log for log in query.yield_per(1000) if all(
+                regex.search(getattr(log, property))
+                for property, regex in regexes
+            ))
+        else:
+            logs = query.limit(limit + 1)
+        logs = list(islice(logs, limit + 1))
+        return {
+            'logs': [log.serialized for log in logs[:limit]],
+            'cursor': logs[limit - 1].id if len(logs) > limit else None
+        }
+
+    @classmethod
+    def device_logs(cls, device, cursor=None, limit=None):
+        # logs received before the device was created (or before its IP
+        # address was set) are not linked to the device: they are found
+        # with their source.
+        limit = min(int(limit or cls.page_size), cls.max_page_size)
+        query = cls.query.filter(or_(
+            cls.device_id == device.id,
+            and_(cls.device_id.is_(None), cls.source == device.ip_address)
+        ))
+        if cursor:
+            query = query.filter(cls.id < int(cursor))
+        logs = query.order_by(cls.id.desc()).limit(limit + 1).all()
+        return logs[:limit], logs[limit - 1].id if len(logs) > limit else None
+
+    @classmethod
+    def full_text_search(cls, search, cursor=None, limit=None):
+        # logs are sorted by relevance: the cursor is the number of logs
+        # already returned
+        limit = min(int(limit or cls.page_size), cls.max_page_size)
+        offset, dialect = int(cursor or 0), db.engine.dialect.name
+        if dialect == 'postgresql':
+            vector = func.to_tsvector(text("'simple'"), cls.content)
+            query = func.plainto_tsquery(text("'simple'"), search)
+            logs = cls.query.filter(vector.op('@@')(query)).order_by(
+                func.ts_rank(vector, query).desc(),
+                cls.id.desc()
+            ).offset(offset).limit(limit + 1).all()
+        elif dialect == 'sqlite' and db.engine.has_table('LogSearch'):
+            ids = [id for id, in db.session.execute(text(
+                'SELECT rowid FROM LogSearch WHERE LogSearch MATCH :search '
+                'ORDER BY rank LIMIT :limit OFFSET :offset'
+            ), {
+                # each word is quoted, so that punctuation is not read as
+                # part of the FTS5 query syntax
+                'search': ' '.join(
+                    '"{}"'.format(word.replace('"', '""'))
+                    for word in search.split()
+                ),
+                'limit': limit + 1,
+                'offset': offset
+            })]
+            logs = {log.id: log for log in cls.query.filter(cls.id.in_(ids))}
+            logs = [logs[id] for id in ids if id in logs]
+        else:
+            query = cls.query
+            for word in search.split():
+                query = query.filter(cls.content.ilike(like_pattern(word)))
+            query = query.order_by(cls.id.desc())
+            logs = query.offset(offset).limit(limit + 1).all()
+        return {
+            'logs': [log.serialized for log in logs[:limit]],
+            'cursor': offset + limit if len(logs) > limit else None
+        }
+
+
+def create_full_text_index(table, connection, **kwargs):
+    # PostgreSQL: GIN index on the text search vector of the logs.
+    # SQLite: FTS5 table kept up-to-date by triggers, when FTS5 is available.
+    if connection.dialect.name == 'postgresql':
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS log_content_search ON "Log" '
+            "USING gin (to_tsvector('simple', content))"
+        )
+    elif connection.dialect.name == 'sqlite':
+        try:
+            connection.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS LogSearch USING '
+                "fts5(content, content='Log', content_rowid='id')"
+            )
+        except OperationalError:
+            return
+        for name, event_type, statement in (
+            ('insert', 'INSERT', 'INSERT INTO LogSearch(rowid, content) '
+                'VALUES (new.id, new.content);'),
+            ('delete', 'DELETE', 'INSERT INTO LogSearch(LogSearch, rowid, '
+                "content) VALUES ('delete', old.id, old.content);"),
+            ('update', 'UPDATE', 'INSERT INTO LogSearch(LogSearch, rowid, '
+                "content) VALUES ('delete', old.id, old.content); "
+                'INSERT INTO LogSearch(rowid, content) '
+                'VALUES (new.id, new.content);')
+        ):
+            connection.execute(
+                f'CREATE TRIGGER IF NOT EXISTS log_search_{name} AFTER '
+                f'{event_type} ON Log BEGIN {statement} END'
+            )
+
+
+def drop_full_text_index(table, connection, **kwargs):
+    # the index and the triggers are dropped with the Log table
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS LogSearch')
+
+
+event.listen(Log.__table__, 'after_create', create_full_text_index)
+event.listen(Log.__table__, 'after_drop', drop_full_text_index)
+
+
+def create_missing_full_text_index():
+    # the Log table of a database created before the full-text index has
+    # no index: it is created at startup, and filled with the existing logs
+    with db.engine.begin() as connection:
+        dialect = connection.dialect
+        if dialect.name == 'sqlite':
+            if dialect.has_table(connection, 'LogSearch'):
+                return
+            create_full_text_index(Log.__table__, connection)
+            if dialect.has_table(connection, 'LogSearch'):
+                connection.execute(
+                    "INSERT INTO LogSearch(LogSearch) VALUES ('rebuild')"
+                )
+        elif dialect.name == 'postgresql':
+            create_full_text_index(Log.__table__, connection)
+
+
+def like_pattern(value):
+    for character in ('\\', '%', '_'):
+        value = value.replace(character, f'\\{character}')
+    return f'%{value}%'
+
 
 class LogRule(CustomBase):
 
@@ -80,6 +261,7 @@ class LogRule(CustomBase):
     sourceregex = Column(Boolean)
     content = Column(String)
     contentregex = Column(Boolean)
+    retention = Column(Integer, default=0)
     jobs = relationship(
         'Job',
         secondary=job_log_rule_table,
@@ -94,3 +276,324 @@ class LogRule(CustomBase):
         properties = self.properties
         properties['jobs'] = [obj.properties for obj in getattr(self, 'jobs')]
         return properties
+
+
+class DeviceIndex(object):
+
+    # the index is reloaded when a device is created, updated or deleted,
+    # and at least every "ttl" seconds (devices changed by another process)
+    ttl = 60
+
+    def __init__(self):
+        self.lock, self.devices, self.loaded = Lock(), {}, 0
+
+    def invalidate(self, *args):
+        self.loaded = 0
+
+    def get(self, ip_address):
+        if time() - self.loaded > self.ttl:
+            with self.lock:
+                if time() - self.loaded > self.ttl:
+                    self.loaded = time()
+                    self.devices = dict(db.session.query(
+                        Device.ip_address,
+                        Device.id
+                    ).filter(Device.ip_address.isnot(None)))
+        return self.devices.get(ip_address)
+
+
+class LogRuleMatcher(object):
+
+    # the rules are compiled again when a rule is saved or deleted, and at
+    # least every "ttl" seconds (rules changed by another process)
+    ttl = 10
+
+    def __init__(self):
+        self.lock = Lock()
+        self.rules, self.version, self.loaded = None, 0, 0
+
+    def invalidate(self):
+        with self.lock:
+            self.rules, self.version = None, self.version + 1
+
+    @property
+    def compiled_rules(self):
+        rules = self.rules
+        if rules is None or time() - self.loaded > self.ttl:
+            with self.lock:
+                version, loaded = self.version, time()
+            rules = self.compile_rules()
+            with self.lock:
+                # the rules were changed while they were being compiled
+                if version == self.version:
+                    self.rules, self.loaded = rules, loaded
+        return rules
+
+    def compile_rules(self):
+        # rules with a fixed source are indexed by source: a log is only
+        # tested against the rules of its source and the rules without one
+        rules_per_source, other_rules = defaultdict(list), []
+        rule_jobs = {}
+        for log_rule in LogRule.query.all():
+            rule_jobs[log_rule.id] = [job.id for job in log_rule.jobs]
+            if log_rule.source and not log_rule.sourceregex:
+                rules_per_source[log_rule.source].append(log_rule)
+            else:
+                other_rules.append(log_rule)
+        return {
+            source: self.compile_group(log_rules)
+            for source, log_rules in rules_per_source.items()
+        }, self.compile_group(other_rules), rule_jobs
+
+    def compile_group(self, log_rules):
+        rules, content_rules, patterns = [], [], []
+        for log_rule in log_rules:
+            try:
+                source = (
+                    compile(log_rule.source)
+                    if log_rule.source and log_rule.sourceregex else None
+                )
+                pattern = log_rule.content and (
+                    log_rule.content if log_rule.contentregex
+                    else escape(log_rule.content)
+                )
+                content = compile(pattern) if pattern else None
+            except regex_error:
+                # a rule with an invalid regular expression never matches
+                continue
+            if pattern:
+                content_rules.append((log_rule.id, source, content))
+                patterns.append(pattern)
+            else:
+                rules.append((log_rule.id, source, content))
+        return rules, content_rules, self.combine(patterns)
+
+    def combine(self, patterns):
+        # all content patterns are combined into a single regular expression
+        # that discards most logs in one scan. Patterns with back references
+        # cannot be combined (the groups are renumbered).
+        if not patterns or any(
+            search(r'\\[1-9]|\(\?P=', pattern) for pattern in patterns
+        ):
+            return None
+        try:
+            return compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+        except regex_error:
+            return None
+
+    def match(self, source, content):
+        rules_per_source, other_rules, _ = self.compiled_rules
+        matches = []
+        for rules, content_rules, scan in (
+            rules_per_source.get(source, ((), (), None)),
+            other_rules
+        ):
+            if content_rules and (not scan or scan.search(content)):
+                rules = rules + content_rules
+            matches.extend(
+                rule_id for rule_id, source_regex, content_regex in rules
+                if (not source_regex or source_regex.search(source))
+                and (not content_regex or content_regex.search(content))
+            )
+        return matches
+
+    def match_jobs(self, source, content):
+        rule_jobs = self.compiled_rules[2]
+        return {
+            job_id for rule_id in self.match(source, content)
+            for job_id in rule_jobs[rule_id]
+        }
+
+
+class JobTriggers(object):
+
+    def __init__(self):
+        self.lock, self.windows, self.window = Lock(), {}, 5
+
+    def init_app(self, app):
+        self.window = app.config['LOG_TRIGGER_WINDOW']
+
+    def trigger(self, job_ids, source, log_id=None):
+        # all logs received from a source within a window trigger a single
+        # run of each job: the windows are closed by the ingesting worker,
+        # which schedules the run with the ids of the logs in its arguments.
+        end = time() + self.window
+        with self.lock:
+            for job_id in job_ids:
+                window = self.windows.setdefault((job_id, source), (end, []))
+                log_ids = window[1]
+                if log_id:
+                    log_ids.append(log_id)
+
+    def close_windows(self):
+        now = time()
+        with self.lock:
+            closed = [
+                (key, log_ids) for key, (end, log_ids) in self.windows.items()
+                if end <= now
+            ]
+            for key, _ in closed:
+                del self.windows[key]
+        for (job_id, source), log_ids in closed:
+            scheduler.add_job(
+                id=f'log trigger {job_id} {source} {now}',
+                func=log_trigger_job,
+                run_date=datetime.now(),
+                args=[job_id, source, log_ids],
+                trigger='date'
+            )
+
+
+def log_trigger_job(job_id, source, log_ids):
+    with scheduler.app.app_context():
+        job = fetch(Job, id=job_id)
+        if not job:
+            return
+        job.try_run(
+            {'source': source, 'logs': log_ids},
+            trigger=f'Log rule (logs {", ".join(map(str, log_ids))})'
+        )
+        db.session.commit()
+
+
+log_rule_matcher, job_triggers = LogRuleMatcher(), JobTriggers()
+device_index = DeviceIndex()
+
+for event_type in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Device, event_type, device_index.invalidate, propagate=True)
+
+
+class LogIngestion(object):
+
+    # SQLite limits the number of parameters of a statement
+    rows_per_insert = 400
+
+    def __init__(self):
+        self.app, self.writer = None, None
+        self.condition, self.lock = Condition(), Lock()
+        self.queue = deque(maxlen=100000)
+        self.batch_size, self.interval = 1000, 0.2
+        self.received = self.dropped = self.written = self.failed = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.queue = deque(self.queue, maxlen=app.config['SYSLOG_QUEUE_SIZE'])
+        self.batch_size = app.config['SYSLOG_BATCH_SIZE']
+        self.interval = app.config['SYSLOG_BATCH_INTERVAL'] / 1000
+
+    @property
+    def status(self):
+        return {
+            'queue_depth': len(self.queue),
+            'queue_size': self.queue.maxlen,
+            'received': self.received,
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed': self.failed
+        }
+
+    def enqueue(self, source, data):
+        # the receiver only stores the raw message: when the buffer is full,
+        # the oldest message is overwritten and counted as dropped.
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((source, data, str(datetime.now())))
+        self.received += 1
+        if not self.writer:
+            self.start()
+        elif len(self.queue) >= self.batch_size:
+            with self.condition:
+                self.condition.notify()
+
+    def start(self):
+        self.writer = Thread(target=self.write_forever)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write_forever(self):
+        # the writer must outlive any error: the messages of a failed batch
+        # are counted as failed, and the next batch is written as usual.
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.queue) >= self.batch_size,
+                    self.interval
+                )
+            try:
+                self.flush()
+                job_triggers.close_windows()
+            except Exception as exc:
+                error(f'Syslog: writer error ({exc})')
+
+    def flush(self):
+        with self.lock:
+            while self.queue:
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+                self.write(batch)
+
+    def write(self, batch):
+        with self.app.app_context():
+            try:
+                logs = [{
+                    'source': source,
+                    'content': data.strip().decode(errors='replace'),
+                    'received': received,
+                    'device_id': device_index.get(source)
+                } for source, data, received in batch]
+                triggers = self.insert(logs)
+                db.session.commit()
+            except Exception as exc:
+                db.session.rollback()
+                self.failed += len(batch)
+                error(f'Syslog: {len(batch)} messages not saved ({exc})')
+                return
+        self.written += len(batch)
+        for job_ids, source, log_id in triggers:
+            job_triggers.trigger(job_ids, source, log_id)
+
+    def insert(self, logs):
+        # all logs are bulk inserted: the logs that trigger jobs are inserted
+        # first, and their ids (passed to the jobs) are read afterwards.
+        triggering, rows = [], []
+        for log in logs:
+            job_ids = log_rule_matcher.match_jobs(log['source'], log['content'])
+            if job_ids:
+                triggering.append((job_ids, log))
+            else:
+                rows.append(log)
+        log_ids = self.insert_rows([log for _, log in triggering], True)
+        self.insert_rows(rows)
+        return [
+            (job_ids, log['source'], log_id)
+            for (job_ids, log), log_id in zip(triggering, log_ids)
+        ]
+
+    def insert_rows(self, rows, returning=False):
+        table, log_ids = Log.__table__, []
+        dialect = db.engine.dialect.name
+        for index in range(0, len(rows), self.rows_per_insert):
+            chunk = rows[index:index + self.rows_per_insert]
+            if not returning:
+                db.session.execute(table.insert().values(chunk))
+            elif dialect == 'postgresql':
+                log_ids.extend(row.id for row in db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id)
+                ))
+            elif dialect == 'sqlite':
+                # the rows of an insert get consecutive ids on SQLite (the
+                # database is locked during the insert): they are the ids
+                # before the id of the last row.
+                last_id = db.session.execute(
+                    table.insert().values(chunk)
+                ).lastrowid
+                log_ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+            else:
+                log_ids.extend(db.session.execute(
+                    table.insert().values(row)
+                ).inserted_primary_key[0] for row in chunk)
+        return log_ids
+
+
+log_ingestion = LogIngestion()
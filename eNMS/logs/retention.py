@@ -0,0 +1,161 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from gzip import open as gzip_open
+from json import dumps, loads
+from pathlib import Path
+from re import compile
+from sqlalchemy import select
+from threading import Lock
+
+from eNMS import db, scheduler
+from eNMS.logs.models import Log, LogRule, log_rule_matcher
+
+
+class LogRetention(object):
+
+    def __init__(self):
+        self.app, self.lock = None, Lock()
+        self.retention, self.source_retention = 0, {}
+        self.batch_size, self.archive_path = 10000, None
+
+    def init_app(self, app):
+        self.app = app
+        self.retention = app.config['LOG_RETENTION']
+        self.source_retention = app.config['LOG_SOURCE_RETENTION']
+        self.batch_size = app.config['LOG_PURGE_BATCH_SIZE']
+        archive_path = app.config['LOG_ARCHIVE_PATH']
+        self.archive_path = Path(archive_path) if archive_path else None
+        scheduler.add_job(
+            id='log_retention',
+            func=purge_logs,
+            trigger='interval',
+            seconds=app.config['LOG_PURGE_INTERVAL'],
+            replace_existing=True
+        )
+
+    def log_retention(self, source, content, rule_retention):
+        # the retention of a source takes precedence over the retention of
+        # the rules matching the log, which takes precedence over the
+        # default retention (0 means that logs are never deleted)
+        if source in self.source_retention:
+            return self.source_retention[source]
+        retentions = [
+            rule_retention[rule_id]
+            for rule_id in log_rule_matcher.match(source, content)
+            if rule_id in rule_retention
+        ]
+        return max(retentions) if retentions else self.retention
+
+    def purge(self):
+        with self.lock:
+            rule_retention = {
+                log_rule.id: log_rule.retention
+                for log_rule in LogRule.query.all() if log_rule.retention
+            }
+            retentions = [
+                retention for retention in (
+                    self.retention,
+                    *self.source_retention.values(),
+                    *rule_retention.values()
+                ) if retention
+            ]
+            if not retentions:
+                return 0
+            now, table = datetime.now(), Log.__table__
+            oldest = str(now - timedelta(days=min(retentions)))
+            purged, last_id = 0, 0
+            # logs are read and deleted in batches, in one transaction per
+            # batch, so that log ingestion is never blocked for long
+            while True:
+                logs = db.session.execute(
+                    select([table.c.id, table.c.source, table.c.content,
+                            table.c.received])
+                    .where(table.c.received < oldest)
+                    .where(table.c.id > last_id)
+                    .order_by(table.c.id)
+                    .limit(self.batch_size)
+                ).fetchall()
+                if not logs:
+                    return purged
+                last_id = logs[-1].id
+                expired = []
+                for log in logs:
+                    retention = self.log_retention(
+                        log.source,
+                        log.content,
+                        rule_retention
+                    )
+                    limit = str(now - timedelta(days=retention))
+                    if retention and log.received < limit:
+                        expired.append(log)
+                if not expired:
+                    continue
+                if self.archive_path:
+                    self.archive(expired)
+                db.session.execute(table.delete().where(
+                    table.c.id.in_([log.id for log in expired])
+                ))
+                db.session.commit()
+                purged += len(expired)
+
+    def archive(self, logs):
+        # deleted logs are appended to one compressed file per day, in
+        # JSON lines format (one log per line).
+        self.archive_path.mkdir(parents=True, exist_ok=True)
+        logs_per_day = defaultdict(list)
+        for log in logs:
+            logs_per_day[log.received[:10]].append(dumps(dict(log)))
+        for day, lines in logs_per_day.items():
+            path = self.archive_path / f'logs-{day}.jsonl.gz'
+            with gzip_open(path, 'at', encoding='utf-8') as archive:
+                archive.write('\n'.join(lines) + '\n')
+
+    def search_archives(self, filters, cursor=None, limit=None):
+        # archives are searched from the most recent to the oldest day:
+        # the cursor is the number of logs already returned
+        limit = min(int(limit or Log.page_size), Log.max_page_size)
+        offset, logs = int(cursor or 0), []
+        if not self.archive_path or not self.archive_path.exists():
+            return {'logs': logs, 'cursor': None}
+        tests = []
+        for property in ('source', 'content'):
+            value = filters.get(property)
+            if not value:
+                continue
+            if filters.get(f'{property}regex'):
+                tests.append((property, compile(value).search))
+            else:
+                tests.append((property, lambda log, value=value.lower():
+                              value in log.lower()))
+        start, end = filters.get('start', ''), filters.get('end')
+        for path in sorted(self.archive_path.glob('logs-*.jsonl.gz'))[::-1]:
+            day = path.name[5:15]
+            if day < start[:10] or end and day > end[:10]:
+                continue
+            with gzip_open(path, 'rt', encoding='utf-8') as archive:
+                day_logs = [loads(line) for line in archive if line.strip()]
+            for log in reversed(day_logs):
+                if not all(test(log[property]) for property, test in tests):
+                    continue
+                if start and log['received'] < start:
+                    continue
+                if end and log['received'] > end:
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                logs.append(log)
+                if len(logs) > limit:
+                    return {
+                        'logs': logs[:limit],
+                        'cursor': int(cursor or 0) + limit
+                    }
+        return {'logs': logs, 'cursor': None}
+
+
+def purge_logs():
+    with scheduler.app.app_context():
+        log_retention.purge()
+
+
+log_retention = LogRetention()
@@ -1,5 +1,4 @@
 from flask import jsonify, render_template, request
-from re import search
 
 from eNMS import db
 from eNMS.automation.models import Job
@@ -8,7 +7,13 @@ from eNMS.base.helpers import fetch, get, post
 from eNMS.base.properties import pretty_names
 from eNMS.logs import bp
 from eNMS.logs.forms import LogAutomationForm, LogFilteringForm
-from eNMS.logs.models import Log, LogRule
+from eNMS.logs.models import (
+    Log,
+    log_ingestion,
+    LogRule,
+    log_rule_matcher
+)
+from eNMS.logs.retention import log_retention
 
 
 @get(bp, '/log_management', 'Logs Section')
@@ -18,8 +23,8 @@ def log_management():
         'log_management.html',
         log_filtering_form=log_filtering_form,
         names=pretty_names,
-        fields=('source', 'content'),
-        logs=Log.serialize()
+        fields=('received', 'source', 'content'),
+        logs=Log.search({})
     )
 
 
@@ -36,6 +41,11 @@ def syslog_automation():
     )
 
 
+@get(bp, '/ingestion_status', 'Logs Section')
+def ingestion_status():
+    return jsonify(log_ingestion.status)
+
+
 @post(bp, '/delete_log/<log_id>', 'Edit Logs Section')
 def delete_log(log_id):
     log = fetch(Log, id=log_id)
@@ -46,19 +56,37 @@ def delete_log(log_id):
 
 @post(bp, '/filter_logs', 'Edit Logs Section')
 def filter_logs():
-    logs = [log for log in Log.serialize() if all(
-        # if the regex property is not in the request, the
-        # regex box is unticked and we only check that the values of the
-        # filters are contained in the values of the log
-        request.form[prop] in str(val) if not prop + 'regex' in request.form
-        # if it is ticked, we use re.search to check that the value
-        # of the device property matches the regular expression,
-        # providing that the property field in the form is not empty
-        # (empty field <==> property ignored)
-        else search(request.form[prop], str(val)) for prop, val in log.items()
-        if prop in request.form and request.form[prop]
-    )]
-    return jsonify(logs)
+    # if the regex box of a property is unticked, the value of the filter
+    # must be contained in the log (case-insensitive). Otherwise, it is a
+    # regular expression. An empty filter is ignored.
+    return jsonify(Log.search(
+        request.form,
+        request.form.get('cursor'),
+        request.form.get('limit')
+    ))
+
+
+@post(bp, '/search_logs', 'Edit Logs Section')
+def search_logs():
+    return jsonify(Log.full_text_search(
+        request.form.get('search', ''),
+        request.form.get('cursor'),
+        request.form.get('limit')
+    ))
+
+
+@post(bp, '/search_archives', 'Logs Section')
+def search_archives():
+    return jsonify(log_retention.search_archives(
+        request.form,
+        request.form.get('cursor'),
+        request.form.get('limit')
+    ))
+
+
+@post(bp, '/purge_logs', 'Edit Logs Section')
+def purge_logs():
+    return jsonify({'success': True, 'purged': log_retention.purge()})
 
 
 @post(bp, '/get_log_rule/<log_rule_id>', 'Logs Section')
@@ -74,6 +102,7 @@ def save_log_rule():
     ]
     log_rule = factory(LogRule, **data)
     db.session.commit()
+    log_rule_matcher.invalidate()
     return jsonify(log_rule.serialized)
 
 
@@ -82,4 +111,5 @@ def delete_log_rule(log_id):
     log_rule = fetch(LogRule, id=log_id)
     db.session.delete(log_rule)
     db.session.commit()
+    log_rule_matcher.invalidate()
     return jsonify({'success': True})
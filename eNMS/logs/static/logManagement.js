@@ -8,6 +8,8 @@ logs: false
 */
 
 const table = $('#table').DataTable(); // eslint-disable-line new-cap
+// the "More logs" button loads the next page of the last filter or search
+let lastQuery = ['/logs/filter_logs', '#filtering-form', '#cursor'];
 
 /**
  * Add log to datatable.
@@ -24,25 +26,55 @@ function addLog(properties) {
   $(rowNode).attr('id', `${properties.id}`);
 }
 
-(function() {
-  for (let i = 0; i < logs.length; i++) {
-    addLog(logs[i]);
+/**
+ * Add a page of logs to datatable.
+ * @param {page} page - Logs, and cursor of the next page.
+ */
+function addLogs(page) {
+  for (let i = 0; i < page.logs.length; i++) {
+    addLog(page.logs[i]);
   }
+  $(lastQuery[2]).val(page.cursor || '');
+  $('#more-logs').toggle(page.cursor != null);
+}
+
+(function() {
+  addLogs(logs);
 })();
 
 /**
  * Filter logs.
  */
 function filterLogs() { // eslint-disable-line no-unused-vars
-  fCall('/logs/filter_logs', '#filtering-form', function(logs) {
+  lastQuery = ['/logs/filter_logs', '#filtering-form', '#cursor'];
+  $('#cursor').val('');
+  fCall('/logs/filter_logs', '#filtering-form', function(page) {
     table.clear().draw();
-    for (let i = 0; i < logs.length; i++) {
-      addLog(logs[i]);
-    }
+    addLogs(page);
     alertify.notify(`Logs successfully filtered.`, 'success', 5);
   });
 }
 
+/**
+ * Full-text search: logs are sorted by relevance.
+ */
+function searchLogs() { // eslint-disable-line no-unused-vars
+  lastQuery = ['/logs/search_logs', '#search-form', '#search-cursor'];
+  $('#search-cursor').val('');
+  fCall('/logs/search_logs', '#search-form', function(page) {
+    table.clear().draw();
+    addLogs(page);
+    alertify.notify(`Search complete.`, 'success', 5);
+  });
+}
+
+/**
+ * Load the next page of logs.
+ */
+function moreLogs() { // eslint-disable-line no-unused-vars
+  fCall(lastQuery[0], lastQuery[1], addLogs);
+}
+
 /**
  * Delete log.
  * @param {id} id - Id of the log to be deleted.
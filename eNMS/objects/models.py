@@ -1,7 +1,18 @@
-from re import search
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float
-from sqlalchemy.orm import backref, relationship
+from collections import defaultdict
+from functools import lru_cache
+from re import compile, findall
+from sqlalchemy import (
+    Boolean,
+    Column,
+    ForeignKey,
+    func,
+    Integer,
+    String,
+    Float
+)
+from sqlalchemy.orm import aliased, backref, joinedload, relationship
 
+from eNMS import db
 from eNMS.base.associations import (
     pool_device_table,
     pool_link_table,
@@ -36,6 +47,19 @@ class Object(CustomBase):
         'polymorphic_on': type
     }
 
+    def update(self, **kwargs):
+        super().update(**kwargs)
+        # only the object that was created or updated is matched against the
+        # pools: the other objects cannot have changed pool. As in
+        # compute_pool, a pool without criteria for this type of object
+        # matches all objects of this type.
+        for pool in Pool.query.all():
+            if pool.object_match(self):
+                if pool not in self.pools:
+                    self.pools.append(pool)
+            elif pool in self.pools:
+                self.pools.remove(pool)
+
 
 ParentDevice = type('CustomDevice', (Object,), {
     '__tablename__': 'CustomDevice',
@@ -172,20 +196,69 @@ class Pool(AbstractPool):
             properties[prop] = [obj.properties for obj in getattr(self, prop)]
         return properties
 
-    def compute_pool(self):
-        self.devices = list(filter(self.object_match, Device.query.all()))
-        self.links = []
-        for link in Link.query.all():
-            # source and destination do not belong to a link __dict__, because
-            # they are SQLalchemy relationships and not columns
-            # we update __dict__ with these properties for the filtering
-            # system to include them
-            link.__dict__.update({
-                'source': link.source,
-                'destination': link.destination
-            })
-            if self.object_match(link):
-                self.links.append(link)
+    def compute_pool(self, devices=None, links=None):
+        if sql_matching():
+            self.save_members(self.query_ids(Device), self.query_ids(Link))
+            return
+        # the indexes can be shared by several pools (see update_pools),
+        # so that the inventory is loaded only once
+        if not devices:
+            devices, links = index_inventory()
+        self.devices = devices.match(self)
+        self.links = links.match(self)
+
+    def sql_query(self, cls):
+        # the criteria are translated into a single SQL query: equality for
+        # exact matches, and the POSIX regular expression operator "~"
+        query, python_criteria = db.session.query(cls), False
+        for property, value, regex in self.criteria(cls.class_type):
+            if property in ('source', 'destination'):
+                device = aliased(Device, flat=True)
+                query = query.join(
+                    device,
+                    getattr(cls, f'{property}_id') == device.id
+                )
+                column = device.name
+            else:
+                column = getattr(cls, property)
+            # numeric properties are compared as python strings ("12.0"),
+            # and some regular expressions have another meaning in
+            # PostgreSQL: they are matched in python after the query.
+            if (
+                not isinstance(column.type, String)
+                or regex and not posix_compatible(value)
+            ):
+                python_criteria = True
+                continue
+            # as in python, a null value is compared as the string "None"
+            column = func.coalesce(column, 'None')
+            query = query.filter(
+                column.op('~')(value) if regex else column == value
+            )
+        return query, python_criteria
+
+    def query_ids(self, cls):
+        query, python_criteria = self.sql_query(cls)
+        if python_criteria:
+            return [obj.id for obj in query if self.object_match(obj)]
+        return [id for id, in query.with_entities(cls.id)]
+
+    def save_members(self, device_ids, link_ids):
+        # the associations are rewritten with bulk inserts instead of going
+        # through the devices and links relationships
+        if not self.id:
+            db.session.add(self)
+        db.session.flush()
+        for table, column, ids in (
+            (pool_device_table, 'device_id', device_ids),
+            (pool_link_table, 'link_id', link_ids)
+        ):
+            db.session.execute(table.delete().where(table.c.pool_id == self.id))
+            if ids:
+                db.session.execute(table.insert(), [
+                    {'pool_id': self.id, column: id} for id in ids
+                ])
+        db.session.expire(self, ['devices', 'links'])
 
     def get_properties(self):
         result = {}
@@ -198,22 +271,30 @@ class Pool(AbstractPool):
         result['name'], result['description'] = self.name, self.description
         return result
 
+    def criteria(self, class_type):
+        properties = {
+            'device': device_public_properties,
+            'link': link_public_properties
+        }[class_type]
+        return compile_criteria(tuple(
+            (
+                property,
+                getattr(self, f'{class_type}_{property}'),
+                bool(getattr(self, f'{class_type}_{property}_regex'))
+            )
+            for property in properties
+            # an empty field in the form means that the property is ignored
+            if getattr(self, f'{class_type}_{property}')
+        ))
+
     def object_match(self, obj):
         return all(
-            # if the device-regex property is not in the request, the
-            # regex box is unticked and we only check that the values
-            # are equal.
-            str(value) == getattr(self, f'{obj.class_type}_{prop}')
-            if not getattr(self, f'{obj.class_type}_{prop}_regex')
-            # if it is ticked, we use re.search to check that the value
-            # of the device property matches the regular expression.
-            else search(getattr(self, f'{obj.class_type}_{prop}'), str(value))
-            for prop, value in obj.__dict__.items()
-            # we consider only the properties in the form
-            if f'{obj.class_type}_{prop}' in self.__dict__
-            # providing that the property field in the form is not empty
-            # (empty field <==> property ignored)
-            and getattr(self, f'{obj.class_type}_{prop}')
+            # if the regex box is ticked, we check that the value of the
+            # object property matches the (precompiled) regular expression,
+            # otherwise we only check that the values are equal.
+            regex.search(str(getattr(obj, property))) if regex
+            else str(getattr(obj, property)) == value
+            for property, value, regex in self.criteria(obj.class_type)
         )
 
     def filter_objects(self):
@@ -221,3 +302,69 @@ class Pool(AbstractPool):
             'devices': [device.serialized for device in self.devices],
             'links': [link.serialized for link in self.links]
         }
+
+
+@lru_cache(maxsize=1024)
+def compile_criteria(criteria):
+    return tuple(
+        (property, value, compile(value) if regex else None)
+        for property, value, regex in criteria
+    )
+
+
+class ObjectIndex(object):
+
+    def __init__(self, objects):
+        self.objects = objects
+        # objects indexed by the value of a property, for the properties
+        # that a pool matches exactly (without a regular expression)
+        self.values = {}
+
+    def lookup(self, property, value):
+        if property not in self.values:
+            self.values[property] = defaultdict(list)
+            for obj in self.objects:
+                self.values[property][str(getattr(obj, property))].append(obj)
+        return self.values[property].get(value, [])
+
+    def match(self, pool):
+        if not self.objects:
+            return []
+        criteria = pool.criteria(self.objects[0].class_type)
+        candidates = min((
+            self.lookup(property, value)
+            for property, value, regex in criteria if not regex
+        ), key=len, default=self.objects)
+        return list(filter(pool.object_match, candidates))
+
+
+# escapes that have the same meaning in python and in PostgreSQL (e.g. "\b"
+# is a word boundary in python, and a backspace in PostgreSQL)
+posix_escapes = set('dDsSwWAZnrtf')
+
+
+def posix_compatible(pattern):
+    # escapes, groups ("(?P<name>", "(?i)", etc, except "(?:", "(?=" and
+    # "(?!") and bounds ("{,n}") are not all supported by PostgreSQL, or
+    # not with the same meaning.
+    return (
+        all(
+            char in posix_escapes or not char.isalnum()
+            for char in findall(r'\\(.)', pattern)
+        )
+        and all(char in ':=!' for char in findall(r'\(\?(.)', pattern))
+        and '{,' not in pattern
+    )
+
+
+def sql_matching():
+    # the pool criteria are evaluated by the database when it supports
+    # regular expressions natively
+    return db.engine.dialect.name == 'postgresql'
+
+
+def index_inventory():
+    return ObjectIndex(Device.query.all()), ObjectIndex(Link.query.options(
+        joinedload(Link.source),
+        joinedload(Link.destination)
+    ).all())
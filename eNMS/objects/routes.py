@@ -22,7 +22,13 @@ from eNMS.base.helpers import (
 )
 from eNMS.objects import bp
 from eNMS.objects.forms import AddLink, AddDevice, AddPoolForm, PoolObjectsForm
-from eNMS.objects.models import Link, Device, Pool
+from eNMS.objects.models import (
+    index_inventory,
+    Link,
+    Device,
+    Pool,
+    sql_matching
+)
 from eNMS.base.properties import (
     boolean_properties,
     device_public_properties,
@@ -218,8 +224,9 @@ def filter_pool_objects(pool_id):
 
 @post(bp, '/update_pools', 'Edit Inventory Section')
 def update_pools():
+    indexes = () if sql_matching() else index_inventory()
     for pool in Pool.query.all():
-        pool.compute_pool()
+        pool.compute_pool(*indexes)
     db.session.commit()
     return jsonify({'success': True})
 
@@ -90,8 +90,11 @@ def export_to_google_earth():
 
 @post(bp, '/get_logs/<device_id>', 'Logs Section')
 def get_logs(device_id):
-    device_logs = [
-        log.content for log in Log.query.all()
-        if log.source == fetch(Device, id=device_id).ip_address
-    ]
-    return jsonify('\n'.join(device_logs) or True)
+    # most recent logs of the device (Log.page_size by default), displayed
+    # from the oldest to the most recent
+    logs, _ = Log.device_logs(
+        fetch(Device, id=device_id),
+        request.form.get('cursor'),
+        request.form.get('limit')
+    )
+    return jsonify('\n'.join(log.content for log in logs[::-1]) or True)
@@ -0,0 +1,171 @@
+"""job run history, job limits, workflow plan and log ingestion columns
+
+Revision ID: a3f5d2c81b7e
+Revises: c49c8ef60511
+Create Date: 2026-10-18 09:12:41.508273
+
+"""
+from alembic import op
+from json import dumps
+from pickle import loads
+import sqlalchemy as sa
+from zlib import compress
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f5d2c81b7e'
+down_revision = 'c49c8ef60511'
+branch_labels = None
+depends_on = None
+
+# columns added to existing tables, with the value given to existing rows
+new_columns = {
+    'Job': (
+        (sa.Column('max_processes', sa.Integer(), nullable=True), 50),
+        (sa.Column('device_timeout', sa.Integer(), nullable=True), 0),
+        (sa.Column('max_runtime', sa.Integer(), nullable=True), 0)
+    ),
+    'Workflow': ((sa.Column('plan', sa.PickleType(), nullable=True), None),),
+    'Log': (
+        (sa.Column('received', sa.String(), nullable=True), None),
+        (sa.Column(
+            'device_id',
+            sa.Integer(),
+            sa.ForeignKey(
+                'Device.id',
+                name='fk_Log_device_id_Device',
+                ondelete='SET NULL'
+            ),
+            nullable=True
+        ), None)
+    ),
+    'LogRule': ((sa.Column('retention', sa.Integer(), nullable=True), 0),)
+}
+
+new_indexes = (
+    ('ix_Log_source', 'Log', ['source']),
+    ('ix_Log_received', 'Log', ['received']),
+    ('ix_Log_device_id_id', 'Log', ['device_id', 'id']),
+    ('ix_JobRun_job_id_runtime', 'JobRun', ['job_id', 'runtime']),
+    ('ix_JobRunDeviceResult_run_id', 'JobRunDeviceResult', ['run_id'])
+)
+
+
+def compress_results(results):
+    # same format as eNMS.automation.models.compress_results
+    return compress(dumps(results, default=str).encode())
+
+
+def upgrade():
+    # the tables created by a first start of the new version (db.create_all)
+    # already exist: only what is missing is created.
+    # The columns are added in batch mode: SQLite cannot add a foreign key
+    # to an existing table, which is copied instead.
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = inspector.get_table_names()
+    for table, columns in new_columns.items():
+        existing = {column['name'] for column in inspector.get_columns(table)}
+        columns = [(c, v) for c, v in columns if c.name not in existing]
+        if not columns:
+            continue
+        with op.batch_alter_table(table) as batch_op:
+            for column, _ in columns:
+                batch_op.add_column(column)
+        for column, value in columns:
+            if value is not None:
+                op.execute(sa.table(table, sa.column(column.name)).update()
+                           .values({column.name: value}))
+        # the full-text search triggers are lost when the Log table is
+        # copied: the index is created again at startup
+        if table == 'Log' and bind.dialect.name == 'sqlite':
+            op.execute('DROP TABLE IF EXISTS LogSearch')
+    if 'JobRun' not in tables:
+        op.create_table('JobRun',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.Integer(), nullable=True),
+        sa.Column('runtime', sa.String(), nullable=True),
+        sa.Column('success', sa.Boolean(), nullable=True),
+        sa.Column('trigger', sa.String(), nullable=True),
+        sa.Column('payload', sa.LargeBinary(), nullable=True),
+        sa.ForeignKeyConstraint(['job_id'], ['Job.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'JobRunDeviceResult' not in tables:
+        op.create_table('JobRunDeviceResult',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('run_id', sa.Integer(), nullable=True),
+        sa.Column('device_name', sa.String(), nullable=True),
+        sa.Column('success', sa.Boolean(), nullable=True),
+        sa.Column('payload', sa.LargeBinary(), nullable=True),
+        sa.ForeignKeyConstraint(['run_id'], ['JobRun.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    for name, table, columns in new_indexes:
+        if name not in {index['name'] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+    if 'logs' in {column['name'] for column in inspector.get_columns('Job')}:
+        copy_job_logs()
+        with op.batch_alter_table('Job') as batch_op:
+            batch_op.drop_column('logs')
+
+
+def copy_job_logs():
+    # the results of each job were stored in a pickled dictionary (runtime
+    # to results): each entry becomes a run of the job.
+    connection = op.get_bind()
+    job_run = sa.Table(
+        'JobRun',
+        sa.MetaData(),
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('job_id', sa.Integer()),
+        sa.Column('runtime', sa.String()),
+        sa.Column('success', sa.Boolean()),
+        sa.Column('payload', sa.LargeBinary())
+    )
+    device_result = sa.table(
+        'JobRunDeviceResult',
+        sa.column('run_id', sa.Integer()),
+        sa.column('device_name', sa.String()),
+        sa.column('success', sa.Boolean()),
+        sa.column('payload', sa.LargeBinary())
+    )
+    jobs = connection.execute(sa.text(
+        'SELECT id, logs FROM "Job" WHERE logs IS NOT NULL'
+    )).fetchall()
+    for job_id, logs in jobs:
+        for runtime, results in sorted((loads(logs) or {}).items()):
+            results = dict(results)
+            devices = results.get('devices')
+            if isinstance(devices, dict):
+                results['devices'] = {}
+            run_id = connection.execute(job_run.insert().values(
+                job_id=job_id,
+                runtime=str(runtime),
+                success=bool(results.get('success')),
+                payload=compress_results(results)
+            )).inserted_primary_key[0]
+            if not isinstance(devices, dict):
+                continue
+            for device, device_results in devices.items():
+                connection.execute(device_result.insert().values(
+                    run_id=run_id,
+                    device_name=device,
+                    success=bool(device_results.get('success')),
+                    payload=compress_results(device_results)
+                ))
+
+
+def downgrade():
+    # the run history is not copied back to the jobs
+    op.add_column('Job', sa.Column('logs', sa.PickleType(), nullable=True))
+    op.drop_index('ix_JobRunDeviceResult_run_id', 'JobRunDeviceResult')
+    op.drop_table('JobRunDeviceResult')
+    op.drop_index('ix_JobRun_job_id_runtime', 'JobRun')
+    op.drop_table('JobRun')
+    for name, table, _ in new_indexes[:3]:
+        op.drop_index(name, table)
+    for table, columns in new_columns.items():
+        with op.batch_alter_table(table) as batch_op:
+            for column, _ in columns:
+                batch_op.drop_column(column.name)
@@ -0,0 +1,33 @@
+"""cancellation of the runs of another process
+
+Revision ID: b7e41c9d2f05
+Revises: a3f5d2c81b7e
+Create Date: 2026-10-18 11:47:03.216940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e41c9d2f05'
+down_revision = 'a3f5d2c81b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the table is already created by a first start of the new version
+    if 'JobRunCancellation' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('JobRunCancellation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('job_id', sa.Integer(), nullable=True),
+    sa.Column('runtime', sa.String(), nullable=True),
+    sa.Column('requested', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('JobRunCancellation')
@@ -1,4 +1,13 @@
 from logging import CRITICAL, disable
+
+from eNMS.base.helpers import (
+    get_device_credentials,
+    invalidate_vault_cache,
+    prefetch_device_credentials,
+    vault_helper
+)
+from eNMS.objects.models import Device
+
 disable(CRITICAL)
 
 urls = {
@@ -83,3 +92,51 @@ def test_urls(user_client):
     # logout and test that we cannot access anything anymore
     r = user_client.get('/admin/logout', follow_redirects=True)
     test_authentication(user_client)
+
+
+class VaultStub(object):
+
+    def __init__(self):
+        self.secrets, self.reads = {}, 0
+
+    def read(self, path):
+        self.reads += 1
+        return {'data': {'data': self.secrets[path]}}
+
+    def write(self, path, data):
+        self.secrets[path] = data
+
+
+def test_vault_cache(user_client):
+    app = user_client.application
+    vault_client = getattr(app, 'vault_client', None)
+    use_vault = app.config['USE_VAULT']
+    app.vault_client, app.config['USE_VAULT'] = VaultStub(), True
+    try:
+        devices = Device.query.all()
+        for device in devices:
+            vault_helper(app, f'device/{device.name}', {
+                'username': 'admin',
+                'password': 'admin',
+                'enable_password': 'admin'
+            })
+        prefetch_device_credentials(app, devices)
+        assert app.vault_client.reads == len(devices)
+        for device in devices:
+            assert get_device_credentials(app, device)[0] == 'admin'
+        assert app.vault_client.reads == len(devices)
+        vault_helper(app, f'device/{devices[0].name}', {
+            'username': 'user',
+            'password': 'user',
+            'enable_password': 'user'
+        })
+        assert get_device_credentials(app, devices[0])[0] == 'user'
+        assert app.vault_client.reads == len(devices) + 1
+        # the passwords of the users are never cached
+        vault_helper(app, 'user/admin', {'password': 'admin'})
+        for _ in range(2):
+            assert vault_helper(app, 'user/admin')['password'] == 'admin'
+        assert app.vault_client.reads == len(devices) + 3
+    finally:
+        app.vault_client, app.config['USE_VAULT'] = vault_client, use_vault
+        invalidate_vault_cache()
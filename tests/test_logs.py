@@ -1,5 +1,25 @@
-from eNMS import db
-from eNMS.logs.models import Log
+from datetime import datetime, timedelta
+from pathlib import Path
+from shutil import rmtree
+from sqlalchemy.exc import OperationalError
+from tempfile import mkdtemp
+
+from eNMS import db, scheduler
+from eNMS.automation.models import Job
+from eNMS.base.helpers import fetch
+from eNMS.logs.models import (
+    create_missing_full_text_index,
+    device_index,
+    job_triggers,
+    Log,
+    log_ingestion,
+    log_rule_matcher,
+    log_trigger_job,
+    LogRule
+)
+from eNMS.logs.retention import log_retention
+from eNMS.objects.models import Device
+from tests.test_objects import create_from_file
 from tests.test_base import check_blueprints
 
 
@@ -16,3 +36,267 @@ def test_create_logs(user_client):
         db.session.add(log_object)
         db.session.commit()
     assert len(Log.query.all()) == 2
+
+
+@check_blueprints('', '/logs')
+def test_log_ingestion(user_client):
+    status = log_ingestion.status
+    for index in range(1500):
+        log = log1 if index % 2 else log2
+        log_ingestion.enqueue('192.168.1.88', log.encode())
+    log_ingestion.flush()
+    assert len(Log.query.all()) == 1500
+    assert Log.query.filter_by(content=log1).count() == 750
+    new_status = user_client.get('/logs/ingestion_status').json
+    assert new_status['received'] - status['received'] == 1500
+    assert new_status['written'] - status['written'] == 1500
+    assert new_status['dropped'] == status['dropped']
+    assert new_status['queue_depth'] == 0
+
+
+def test_log_ingestion_errors(user_client, monkeypatch):
+    def lookup_error(source):
+        raise OperationalError('device lookup', None, None)
+    status = log_ingestion.status
+    with monkeypatch.context() as patch:
+        patch.setattr(device_index, 'get', lookup_error)
+        log_ingestion.enqueue('192.168.1.88', log1.encode())
+        log_ingestion.flush()
+    assert log_ingestion.status['failed'] - status['failed'] == 1
+    log_ingestion.enqueue('192.168.1.88', log1.encode())
+    log_ingestion.flush()
+    assert log_ingestion.status['written'] - status['written'] == 1
+
+
+@check_blueprints('', '/logs')
+def test_log_rule_matching(user_client):
+    for log_rule in (
+        {'name': 'rule1', 'source': '192.168.1.88', 'content': 'to up'},
+        {'name': 'rule2', 'source': '192.168.1.88', 'content': ''},
+        {'name': 'rule3', 'source': '', 'content': r'state to (up|down)',
+            'contentregex': 'y'},
+        {'name': 'rule4', 'source': r'^10\.', 'sourceregex': 'y',
+            'content': 'FastEthernet'}
+    ):
+        user_client.post('/logs/save_log_rule', data=log_rule)
+    rules = {rule.id: rule.name for rule in LogRule.query.all()}
+
+    def match(source, log):
+        return sorted(
+            rules[rule] for rule in log_rule_matcher.match(source, log)
+        )
+    assert match('192.168.1.88', log1) == ['rule1', 'rule2', 'rule3']
+    assert match('192.168.1.88', log2) == ['rule2', 'rule3']
+    assert match('10.0.0.1', log2) == ['rule3', 'rule4']
+    assert match('11.0.0.1', 'no match') == []
+    rule3 = fetch(LogRule, name='rule3')
+    user_client.post(f'/logs/delete_log_rule/{rule3.id}')
+    assert match('10.0.0.1', log2) == ['rule4']
+    # a rule deleted by another process is removed when the rules expire
+    db.session.delete(fetch(LogRule, name='rule4'))
+    db.session.commit()
+    assert match('10.0.0.1', log2) == ['rule4']
+    log_rule_matcher.loaded = 0
+    assert match('10.0.0.1', log2) == []
+
+
+@check_blueprints('', '/logs')
+def test_log_rule_triggers(user_client):
+    job = fetch(Job, name='Start')
+    user_client.post('/logs/save_log_rule', data={
+        'name': 'rule',
+        'content': 'changed state to down',
+        'jobs': [job.id]
+    })
+    for _ in range(100):
+        log_ingestion.enqueue('192.168.1.88', log2.encode())
+        log_ingestion.enqueue('192.168.1.89', log2.encode())
+        log_ingestion.enqueue('192.168.1.88', log1.encode())
+    # the logs are inserted in several statements
+    log_ingestion.rows_per_insert = 30
+    try:
+        log_ingestion.flush()
+    finally:
+        del log_ingestion.rows_per_insert
+
+    def trigger_jobs():
+        return [
+            aps_job for aps_job in scheduler.get_jobs()
+            if aps_job.args[:1] == (job.id,)
+        ]
+    # the windows are still open: nothing is scheduled yet
+    job_triggers.close_windows()
+    assert not trigger_jobs()
+    for key, (_, log_ids) in list(job_triggers.windows.items()):
+        job_triggers.windows[key] = (0, log_ids)
+    # the runs are scheduled immediately: the scheduler is paused so that
+    # they can be inspected before they run.
+    scheduler.pause()
+    try:
+        job_triggers.close_windows()
+        assert (job.id, '192.168.1.88') not in job_triggers.windows
+        aps_jobs = {aps_job.args[1]: aps_job for aps_job in trigger_jobs()}
+        for aps_job in aps_jobs.values():
+            scheduler.remove_job(aps_job.id)
+    finally:
+        scheduler.resume()
+    assert set(aps_jobs) == {'192.168.1.88', '192.168.1.89'}
+    log_ids = aps_jobs['192.168.1.88'].args[2]
+    assert len(set(log_ids)) == 100
+    assert all(
+        (Log.query.get(id).source, Log.query.get(id).content)
+        == ('192.168.1.88', log2) for id in log_ids
+    )
+    log_trigger_job(*aps_jobs['192.168.1.88'].args)
+    run, = fetch(Job, name='Start').runs
+    assert run.trigger == f'Log rule (logs {", ".join(map(str, log_ids))})'
+
+
+@check_blueprints('', '/logs')
+def test_log_search(user_client):
+    for index in range(250):
+        log = log1 if index % 5 else f'{log2} 100%'
+        log_ingestion.enqueue(f'192.168.1.{index % 2}', log.encode())
+    log_ingestion.flush()
+    logs, cursor = [], None
+    while True:
+        page = user_client.post('/logs/filter_logs', data={
+            'cursor': cursor or '',
+            'limit': 60
+        }).json
+        logs.extend(page['logs'])
+        cursor = page['cursor']
+        if not cursor:
+            break
+    assert len(logs) == 250 and len({log['id'] for log in logs}) == 250
+    assert logs == sorted(logs, key=lambda log: log['id'], reverse=True)
+    for filters, number in (
+        ({'content': 'changed STATE to down 100%'}, 50),
+        ({'content': 'to down 1_0%'}, 0),
+        ({'source': '192.168.1.1', 'content': 'updown'}, 125),
+        ({'content': r'state to (up|down)$', 'contentregex': 'y'}, 200),
+        ({'source': r'\.0$', 'sourceregex': 'y', 'content': 'to down'}, 25)
+    ):
+        page = user_client.post('/logs/filter_logs', data=filters).json
+        assert len(page['logs']) == min(number, 100)
+        assert bool(page['cursor']) == (number > 100)
+
+
+@check_blueprints('', '/logs')
+def test_log_full_text_search(user_client):
+    for index in range(150):
+        log = log1 if index % 3 else f'{log2} (error "{index}")'
+        log_ingestion.enqueue('192.168.1.88', log.encode())
+    log_ingestion.flush()
+    page = user_client.post('/logs/search_logs', data={
+        'search': 'LINEPROTO-5-UPDOWN state down',
+        'limit': 30
+    }).json
+    assert len(page['logs']) == 30 and page['cursor'] == 30
+    assert all('to down' in log['content'] for log in page['logs'])
+    page = user_client.post('/logs/search_logs', data={
+        'search': 'LINEPROTO-5-UPDOWN state down',
+        'cursor': 30,
+        'limit': 30
+    }).json
+    assert len(page['logs']) == 20 and not page['cursor']
+    page = user_client.post('/logs/search_logs', data={
+        'search': 'error "42"'
+    }).json
+    assert len(page['logs']) == 1
+    user_client.post(f'/logs/delete_log/{page["logs"][0]["id"]}')
+    page = user_client.post('/logs/search_logs', data={
+        'search': 'error "42"'
+    }).json
+    assert not page['logs']
+    # a database created before the full-text index gets it at startup,
+    # with the logs it already contains
+    for name in ('insert', 'delete', 'update'):
+        db.session.execute(f'DROP TRIGGER log_search_{name}')
+    db.session.execute('DROP TABLE LogSearch')
+    db.session.commit()
+    create_missing_full_text_index()
+    assert db.session.execute(
+        "SELECT count(*) FROM LogSearch WHERE LogSearch MATCH 'error'"
+    ).scalar() == 49
+
+
+@check_blueprints('', '/logs')
+def test_log_retention(user_client):
+    user_client.post('/logs/save_log_rule', data={
+        'name': 'rule',
+        'content': 'to down',
+        'retention': 30
+    })
+    for index in range(60):
+        received = str(datetime.now() - timedelta(days=index))
+        for source in ('192.168.1.88', '192.168.1.89'):
+            for log in (log1, log2):
+                db.session.add(Log(source, log, received))
+    db.session.commit()
+    default_settings = (
+        log_retention.retention,
+        log_retention.source_retention,
+        log_retention.archive_path,
+        log_retention.batch_size
+    )
+    log_retention.retention = 10
+    log_retention.source_retention = {'192.168.1.89': 20}
+    log_retention.archive_path = archive_path = Path(mkdtemp())
+    log_retention.batch_size = 7
+    try:
+        purged = user_client.post('/logs/purge_logs').json['purged']
+        # 192.168.1.88: 50 "up" logs older than 10 days, 30 "down" logs
+        # older than 30 days. 192.168.1.89: 2 * 40 logs older than 20 days
+        assert purged == 50 + 30 + 80
+        assert Log.query.count() == 240 - purged
+        assert len(list(archive_path.glob('logs-*.jsonl.gz'))) == 50
+        page = user_client.post('/logs/search_archives', data={
+            'source': '192.168.1.88',
+            'content': 'TO DOWN',
+            'limit': 20
+        }).json
+        assert len(page['logs']) == 20 and page['cursor'] == 20
+        page = user_client.post('/logs/search_archives', data={
+            'source': '192.168.1.88',
+            'content': 'to (down|up)',
+            'contentregex': 'y',
+            'cursor': 20,
+            'limit': 100
+        }).json
+        assert len(page['logs']) == 60 and not page['cursor']
+        assert user_client.post('/logs/purge_logs').json['purged'] == 0
+    finally:
+        (
+            log_retention.retention,
+            log_retention.source_retention,
+            log_retention.archive_path,
+            log_retention.batch_size
+        ) = default_settings
+        rmtree(archive_path)
+
+
+@check_blueprints('', '/logs')
+def test_device_logs(user_client):
+    create_from_file(user_client, 'europe.xls')
+    device, other_device = Device.query.all()[:2]
+    device.ip_address, other_device.ip_address = '10.0.0.1', '10.0.0.2'
+    db.session.commit()
+    for index in range(150):
+        log_ingestion.enqueue('10.0.0.1', f'log {index}'.encode())
+        log_ingestion.enqueue('10.0.0.2', b'other log')
+    log_ingestion.flush()
+    assert Log.query.filter_by(device_id=device.id).count() == 150
+    logs = user_client.post(f'/views/get_logs/{device.id}').json
+    assert logs.split('\n') == [f'log {index}' for index in range(50, 150)]
+    logs = user_client.post(f'/views/get_logs/{device.id}', data={
+        'limit': 10
+    }).json
+    assert logs.split('\n')[0] == 'log 140'
+    db.session.add(Log('10.0.0.3', 'unknown source'))
+    db.session.commit()
+    other_device = fetch(Device, id=other_device.id)
+    other_device.ip_address = '10.0.0.3'
+    db.session.commit()
+    logs = user_client.post(f'/views/get_logs/{other_device.id}').json
+    assert logs.split('\n')[-2:] == ['other log', 'unknown source']
@@ -1,9 +1,11 @@
 from os.path import join
+from sqlalchemy.dialects import postgresql
 from werkzeug.datastructures import ImmutableMultiDict
 
+from eNMS import db
 from eNMS.base.helpers import fetch
 from eNMS.base.properties import device_subtypes, link_subtypes
-from eNMS.objects.models import Device, Link, Pool
+from eNMS.objects.models import Device, Link, Pool, posix_compatible
 
 from tests.test_base import check_blueprints
 
@@ -136,3 +138,92 @@ def test_pool_management(user_client):
     user_client.post(f'/objects/delete_pool/{p1.id}')
     user_client.post(f'/objects/delete_pool/{p2.id}')
     assert len(Pool.query.all()) == 3
+
+
+@check_blueprints('', '/objects', '/views')
+def test_pool_regex_criteria(user_client):
+    create_from_file(user_client, 'europe.xls')
+    assert posix_compatible(r'^r\d+\.\S*(?:a|b)$')
+    for pattern in (r'\bfrance', r'(?i)france', r'(?P<x>a)', 'a{,2}'):
+        assert not posix_compatible(pattern)
+    user_client.post('/objects/process_pool', data=ImmutableMultiDict([
+        ('name', 'regex'),
+        ('device_location', r'\bfrance\b'),
+        ('device_location_regex', 'y')
+    ]))
+    pool = fetch(Pool, name='regex')
+    france = Device.query.filter_by(location='france').all()
+    assert len(pool.devices) == len(france) > 0
+    # with PostgreSQL, "\b" (a backspace) would not be sent to the database:
+    # the criteria is matched in python
+    for location, python_match in (
+        (r'\bfrance\b', True),
+        (r'^fr\w+$', False)
+    ):
+        pool.device_location = location
+        query, python_criteria = pool.sql_query(Device)
+        sql = str(query.statement.compile(dialect=postgresql.dialect()))
+        assert python_criteria == python_match and ('~' in sql) != python_match
+    db.session.rollback()
+
+
+@check_blueprints('', '/objects', '/views')
+def test_pool_incremental_update(user_client):
+    create_from_file(user_client, 'europe.xls')
+    user_client.post('/objects/process_pool', data=pool1)
+    device = define_device('router', 'france').to_dict()
+    device['subtype'] = 'router'
+    user_client.post('/objects/edit_object', data=device)
+    assert len(fetch(Pool, name='pool1').devices) == 21
+    device['location'] = 'france'
+    user_client.post('/objects/edit_object', data=device)
+    assert len(fetch(Pool, name='pool1').devices) == 22
+    user_client.post('/objects/update_pools')
+    assert len(fetch(Pool, name='pool1').devices) == 22
+
+
+@check_blueprints('', '/objects', '/views')
+def test_pool_update_matches_recompute(user_client):
+    create_from_file(user_client, 'europe.xls')
+    user_client.post('/objects/process_pool', data=pool1)
+    user_client.post('/objects/process_pool', data={'name': 'manual'})
+    pool = fetch(Pool, name='manual')
+    member, other = Device.query.all()[:2]
+    user_client.post(f'/objects/save_pool_objects/{pool.id}', data={
+        'devices': [member.id]
+    })
+    # editing a device updates its pools as a full recompute would, the
+    # pools without criteria (e.g. "All objects") included
+    for device in (other, member):
+        properties = {
+            property: getattr(device, property)
+            for property in ('id', 'name', 'location', 'subtype')
+        }
+        properties.update(type='Device', description='edited')
+        user_client.post('/objects/edit_object', data=properties)
+    members = {
+        pool.name: sorted(device.id for device in pool.devices)
+        for pool in Pool.query.all()
+    }
+    assert other.id in members['manual'] and other.id in members['All objects']
+    for pool in Pool.query.all():
+        pool.compute_pool()
+        devices = sorted(device.id for device in pool.devices)
+        assert {other.id, member.id} & set(devices) == (
+            {other.id, member.id} & set(members[pool.name])
+        )
+    assert len(fetch(Pool, name='pool1').devices) == 21
+
+
+@check_blueprints('', '/objects', '/views')
+def test_pool_sql_matching(user_client):
+    create_from_file(user_client, 'europe.xls')
+    user_client.post('/objects/process_pool', data=pool2)
+    pool = fetch(Pool, name='pool2')
+    devices = sorted(device.id for device in pool.devices)
+    links = [link.id for link in pool.links]
+    assert sorted(pool.query_ids(Device)) == devices
+    pool.save_members([], [])
+    assert not pool.devices and not pool.links
+    pool.save_members(devices, links)
+    assert len(pool.devices) == 12 and len(pool.links) == 4
@@ -1,5 +1,29 @@
-from eNMS.automation.models import Service, service_classes
+from asyncio import sleep
+from collections import Counter
+from functools import partial
+from json import loads
+from pytest import raises
+from threading import Lock, Timer
+from time import sleep as blocking_sleep, time
+
+from eNMS import db
+from eNMS.automation.connections import connection_pool
+from eNMS.automation.executor import executor
+from eNMS.automation.progress import job_progress
+from eNMS.automation.helpers import substitute
+from eNMS.automation.targets import device_updates
+from eNMS.automation.models import (
+    JobRun,
+    JobRunCancellation,
+    JobRunDeviceResult,
+    Service,
+    service_classes
+)
+from eNMS.base.custom_base import factory
+from eNMS.base.helpers import fetch
+from eNMS.objects.models import Device, Pool
 from tests.test_base import check_blueprints
+from tests.test_objects import create_from_file, pool2
 from werkzeug.datastructures import ImmutableMultiDict
 
 # test the creation of configuration service (netmiko / napalm)
@@ -98,3 +122,449 @@ def test_ansible_services(user_client):
     )
     assert len(service_classes['ansible_playbook_service'].query.all()) == 1
     assert len(Service.query.all()) == 16
+
+
+@check_blueprints('/automation')
+def test_multiprocessing_run(user_client):
+    create_from_file(user_client, 'europe.xls')
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'job1',
+        'multiprocessing': 'y',
+        'max_processes': 10,
+        'devices': Device.query.all()
+    })
+    results = job.run()
+    assert results['success']
+    assert len(results['devices']) == len(Device.query.all())
+
+
+@check_blueprints('/automation')
+def test_target_resolution(user_client):
+    create_from_file(user_client, 'europe.xls')
+    user_client.post('/objects/process_pool', data=pool2)
+    pool = fetch(Pool, name='pool2')
+    devices = [device for device in Device.query.all()
+               if device.location != 'france'][:2]
+    job = factory(service_classes['update_inventory_service'], **{
+        'name': 'update',
+        'devices': devices + pool.devices[:1],
+        'pools': [pool],
+        'update_dictionnary': '{"model": "updated"}'
+    })
+    targets = job.compute_targets()
+    names = {device.name for device in devices + pool.devices}
+    assert {target.name for target in targets} == names
+    target = next(iter(targets))
+    assert target.properties['ip_address'] == target.ip_address
+    with raises(AttributeError):
+        target.name = 'renamed'
+    assert job.try_run()['success'] and not device_updates.updates
+    models = db.session.query(Device.model).filter(Device.name.in_(names))
+    assert {model for model, in models} == {'updated'}
+
+
+@check_blueprints('/automation')
+def test_job_runs(user_client):
+    create_from_file(user_client, 'europe.xls')
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'job1',
+        'devices': Device.query.all()
+    })
+    for _ in range(2):
+        results = job.try_run()
+    db.session.commit()
+    runtimes = job.runtimes()
+    assert len(runtimes) == 2
+    run = job.get_run(runtimes[0])
+    assert len(run.device_results) == len(Device.query.all())
+    assert run.results == loads(user_client.post(
+        f'/automation/show_logs/{job.id}'
+    ).json)[runtimes[0]]
+    assert run.results['devices'].keys() == results['devices'].keys()
+    compare = user_client.post(f'/automation/compare_logs/{job.id}').json
+    assert compare['versions'] == runtimes
+    user_client.post(f'/automation/clear_logs/{job.id}')
+    assert not JobRun.query.all() and not JobRunDeviceResult.query.all()
+
+
+@check_blueprints('/automation')
+def test_job_progress(user_client):
+    create_from_file(user_client, 'europe.xls')
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'job1',
+        'multiprocessing': 'y',
+        'max_processes': 10,
+        'devices': Device.query.all()
+    })
+    job.try_run()
+    number_of_devices = len(Device.query.all())
+    progress = user_client.post(
+        f'/automation/job_progress/{job.id}',
+        data={'offset': 3}
+    ).json
+    assert progress['finished'] and progress['success']
+    assert progress['done'] == progress['offset'] == number_of_devices
+    assert len(progress['results']) == number_of_devices - 3
+    assert not progress['pending']
+    run = (0, 'runtime')
+    job_progress.start(run)
+    job_progress.add_targets(run, ['router1', 'router2'])
+    Timer(0.2, job_progress.publish, (run, 'router1', {'success': False}))\
+        .start()
+    progress = job_progress.poll(run, timeout=5)
+    assert progress['results'][0]['device'] == 'router1'
+    assert (progress['done'], progress['failed'], progress['pending']) == (
+        0, 1, 1
+    )
+    assert not job_progress.poll(run, progress['offset'])['results']
+    job_progress.finish(run, False)
+    assert job_progress.poll(run, progress['offset'], timeout=5)['finished']
+
+
+@check_blueprints('/automation')
+def test_job_cancellation(user_client):
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'failing_job',
+        'number_of_retries': 3,
+        'time_between_retries': 60,
+        'max_runtime': 1
+    })
+    start = time()
+    results = job.try_run()
+    assert time() - start < 10
+    assert results['stopped'] == 'Maximum runtime exceeded'
+    job.max_runtime = 0
+    Timer(0.5, lambda: job_progress.cancel(job_progress.find(job.id)))\
+        .start()
+    start = time()
+    results = job.try_run()
+    assert time() - start < 10 and results['stopped'] == 'Cancelled'
+    assert not user_client.post(f'/automation/cancel_job/{job.id}').json
+    # a run is targeted with its runtime
+    for runtime in ('first', 'second'):
+        job_progress.start((job.id, runtime))
+    assert user_client.post(
+        f'/automation/cancel_job/{job.id}',
+        data={'runtime': 'first'}
+    ).json
+    assert job_progress.stopped((job.id, 'first')) == 'Cancelled'
+    assert not job_progress.stopped((job.id, 'second'))
+    progress = user_client.post(f'/automation/job_progress/{job.id}').json
+    assert progress['runtime'] == 'second' and not progress['cancelled']
+    for runtime in ('first', 'second'):
+        job_progress.finish((job.id, runtime), True)
+
+
+def test_job_cancellation_from_another_process(user_client):
+    # the cancellation of a run that is not in this process is stored in
+    # the database, and read by the process that runs it
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'remote_job'
+    })
+    assert user_client.post(
+        f'/automation/cancel_job/{job.id}',
+        data={'runtime': 'remote'}
+    ).json
+    assert fetch(JobRunCancellation, runtime='remote').job_id == job.id
+    job_progress.start((job.id, 'remote'))
+    job_progress.start((job.id, 'other'))
+    job_progress.cancel_checked = 0
+    assert job_progress.stopped((job.id, 'remote')) == 'Cancelled'
+    assert not job_progress.stopped((job.id, 'other'))
+    # without runtime, the runs in progress when it was requested are
+    # cancelled, and not the runs started afterwards
+    job_progress.cancellations.request(job.id, None)
+    blocking_sleep(0.01)
+    job_progress.start((job.id, 'next'))
+    job_progress.cancel_checked = 0
+    assert job_progress.wait((job.id, 'other'), 5) == 'Cancelled'
+    assert not job_progress.stopped((job.id, 'next'))
+    for runtime in ('remote', 'other', 'next'):
+        job_progress.finish((job.id, runtime), True)
+
+
+def test_run_progress_isolation(user_client):
+    # two runs of the same job at the same time: each run has its own
+    # maximum runtime, parent and cancellation
+    first, second = (0, 'first'), (0, 'second')
+    job_progress.start((1, 'parent'), max_runtime=0.1)
+    job_progress.start(first)
+    job_progress.cancel(first)
+    job_progress.start(second, parent=(1, 'parent'))
+    assert job_progress.stopped(first) == 'Cancelled'
+    assert not job_progress.stopped(second)
+    blocking_sleep(0.2)
+    assert job_progress.stopped(second) == 'Maximum runtime exceeded'
+    assert job_progress.find(0) == second
+    for run in (first, second, (1, 'parent')):
+        job_progress.finish(run, True)
+
+
+def test_device_retries(user_client):
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'job1',
+        'number_of_retries': 3,
+        'time_between_retries': 1
+    })
+    delays = [job.retry_delay(attempt) for attempt in range(1, 5)]
+    assert all(2 ** i / 2 <= delays[i] <= 2 ** i for i in range(3))
+    assert delays[3] is None
+    calls = Counter()
+
+    def device_job(target):
+        # even targets fail twice before succeeding
+        calls[target] += 1
+        return {'success': target % 2 or calls[target] > 2}
+
+    def retry(attempt):
+        return 0.01 if attempt < 5 else None
+    for inline in (False, True):
+        calls.clear()
+        results = executor.map(
+            device_job,
+            range(10),
+            4,
+            retry=retry,
+            inline=inline
+        )
+        assert all(result['success'] for result in results.values())
+        assert sum(calls.values()) == 5 + 5 * 3
+        assert results[0]['attempts'] == 3 and 'attempts' not in results[1]
+    # the failed targets of a job running in a worker of the pool are not
+    # retried: the worker would be held during the delays
+    calls.clear()
+    results = executor.execute(
+        partial(executor.map, retry=retry),
+        device_job,
+        range(10),
+        4
+    )
+    assert sum(calls.values()) == 10
+    assert not results[0]['success'] and results[1]['success']
+
+    async def async_job(target):
+        return device_job(target)
+    calls.clear()
+    results = executor.map_async(async_job, range(10), 4, retry=retry)
+    assert all(result['success'] for result in results.values())
+    assert results[2]['attempts'] == 3 and sum(calls.values()) == 20
+
+
+def test_executor_stop(user_client):
+    deadline = time() + 0.5
+
+    def stop():
+        return 'Cancelled' if time() > deadline else None
+
+    def job(target):
+        blocking_sleep(0.2)
+        return {'success': True, 'result': target}
+    results = executor.map(job, range(20), 2, stop=stop)
+    assert len(results) == 20
+    assert 0 < sum(result['success'] for result in results.values()) < 20
+
+    async def async_job(target):
+        await sleep(0.2)
+        return {'success': True, 'result': target}
+    deadline = time() + 0.5
+    results = executor.map_async(async_job, range(20), 2, stop=stop)
+    assert len(results) == 20
+    assert 0 < sum(result['success'] for result in results.values()) < 20
+
+
+def test_executor_timeout(user_client):
+    # the devices that timed out still count against the maximum number
+    # of devices processed at the same time, until their thread ends
+    lock, in_flight, max_in_flight = Lock(), [0], [0]
+
+    def job(target):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        blocking_sleep(0.5)
+        with lock:
+            in_flight[0] -= 1
+        return {'success': True}
+    results = executor.map(job, range(6), 2, timeout=0.1)
+    assert not any(result['success'] for result in results.values())
+    assert max_in_flight[0] == 2
+
+
+def test_retry_after_timeout(user_client):
+    # a device that timed out is retried once its first attempt is over
+    lock, calls, overlaps = Lock(), Counter(), []
+
+    def job(target):
+        with lock:
+            calls[target] += 1
+            overlaps.append(calls[target] > 1)
+            first_attempt = target not in attempted
+            attempted.add(target)
+        blocking_sleep(0.3 if first_attempt else 0)
+        with lock:
+            calls[target] -= 1
+        return {'success': True}
+
+    async def async_job(target):
+        return await executor.run_in_thread(job, target)
+
+    def retry(attempt):
+        return 0 if attempt == 1 else None
+    attempted = set()
+    results = executor.map(job, range(4), 4, timeout=0.2, retry=retry)
+    attempted.clear()
+    results.update(executor.map_async(
+        async_job,
+        range(4, 8),
+        4,
+        timeout=0.2,
+        retry=retry
+    ))
+    assert all(results[target] == {'success': True, 'attempts': 2}
+               for target in range(8))
+    assert not any(overlaps)
+
+
+def test_asynchronous_run(user_client):
+    async def job(target):
+        await sleep(0.1)
+        return {'success': True, 'result': target}
+    results = executor.map_async(job, range(100), 50)
+    assert all(results[i]['result'] == i for i in range(100))
+    results = executor.map_async(job, range(10), 10, timeout=0.01)
+    assert not any(result['success'] for result in results.values())
+
+
+def test_asynchronous_service(user_client):
+    create_from_file(user_client, 'europe.xls')
+    devices = Device.query.all()[:10]
+    job = factory(service_classes['swiss_army_knife_service'], **{
+        'name': 'async_service',
+        'multiprocessing': 'y',
+        'max_processes': 10,
+        'devices': devices
+    })
+
+    def configure(device):
+        # blocking call that opens a session, and fails on odd devices
+        connection_pool.connect(
+            ('netmiko', device.id, 'cisco_ios', False),
+            device.id,
+            object,
+            lambda connection: True,
+            lambda connection: None
+        )
+        blocking_sleep(0.2)
+        if device.id % 2:
+            raise ValueError('configuration failed')
+        return {'success': True, 'result': device.name}
+
+    async def async_job(device, payload):
+        return await executor.run_in_thread(configure, device)
+    job.job = async_job
+    start = time()
+    results = job.try_run()
+    assert time() - start < 1
+    for device in devices:
+        result = results['devices'][device.name]
+        assert result == ({
+            'success': False,
+            'result': 'configuration failed'
+        } if device.id % 2 else {'success': True, 'result': device.name})
+        # the session opened for the device is released with the call
+        assert not connection_pool.active[device.id]
+
+    # the blocking calls of a job run by a worker of the pool run in the
+    # pool as well
+    async def sleep_job(target):
+        return await executor.run_in_thread(blocking_sleep, 0.2)
+    start = time()
+    executor.pool.submit(
+        executor.execute,
+        executor.map_async,
+        sleep_job,
+        range(5),
+        5
+    ).result()
+    assert time() - start < 0.8
+
+
+def test_connection_pool(user_client):
+    opened, closed = [], []
+
+    def connect():
+        connection = connection_pool.connect(
+            ('netmiko', 1, 'cisco_ios', False),
+            1,
+            lambda: opened.append(object()) or opened[-1],
+            lambda connection: True,
+            closed.append
+        )
+        connection_pool.release(connection)
+    with connection_pool.scope():
+        for _ in range(5):
+            connect()
+    assert len(opened) == len(closed) == 1
+    connect()
+    assert len(opened) == len(closed) == 2
+
+
+def test_connection_checkout(user_client):
+    def connect():
+        return connection_pool.connect(
+            ('netmiko', 2, 'cisco_ios', False),
+            2,
+            object,
+            lambda connection: True,
+            lambda connection: None
+        )
+
+    # the sessions of a call are closed at the end of the call, even when
+    # they were opened in another thread of the pool
+    async def job():
+        with connection_pool.checkout():
+            await executor.run_in_thread(connect)
+    executor.run_coroutine(job())
+    assert not connection_pool.active[2]
+    # two calls running in the same thread have their own sessions
+    with connection_pool.checkout():
+        session = connect()
+        with connection_pool.checkout():
+            connect()
+        assert id(session) in connection_pool.sessions
+    assert not connection_pool.active[2]
+    # a call waits for a session until the job stops, or until the timeout
+    wait_timeout, connection_pool.wait_timeout = connection_pool.wait_timeout, 1
+    try:
+        with connection_pool.checkout(lambda: None):
+            connect(), connect()
+            with raises(TimeoutError):
+                connect()
+        with connection_pool.checkout(lambda: 'Cancelled'):
+            connect(), connect()
+            with raises(RuntimeError):
+                connect()
+    finally:
+        connection_pool.wait_timeout = wait_timeout
+    assert not connection_pool.active[2]
+
+
+def test_variable_substitution(user_client):
+    device = Device.query.first()
+    variables = {'device': device, 'payload': {'vrf': 'test'}}
+    template = 'vrf {{payload["vrf"]}} on {{ device.name }} ({{len("ab")}})'
+    result = f'vrf test on {device.name} (2)'
+    assert substitute(template, variables) == result
+    assert substitute('{{[n * 2 for n in range(2)]}}', variables) == '[0, 2]'
+    for forbidden in (
+        '{{device.__class__}}',
+        '{{__import__("os")}}',
+        '{{device._sa_instance_state}}',
+        '{{"{0.__class__}".format(device)}}',
+        '{{str.format_map("{x.__class__}", {"x": device})}}',
+        '{{device.query.session}}',
+        '{{open("/etc/passwd")}}',
+        '{{self}}'
+    ):
+        with raises(ValueError):
+            substitute(forbidden, variables)
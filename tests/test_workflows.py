@@ -1,7 +1,229 @@
+from pathlib import Path
 from requests import get
 from requests.auth import HTTPBasicAuth
+from tempfile import mkdtemp
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
 
+from eNMS import db
+from eNMS.automation.executor import executor
+from eNMS.automation.models import (
+    Job,
+    service_classes,
+    Workflow,
+    WorkflowEdge
+)
+from eNMS.automation.payload import PayloadStore, payload_stores
+from eNMS.base.custom_base import factory
+from eNMS.base.helpers import fetch
+from eNMS.objects.models import Device
 from tests.test_base import check_blueprints
+from tests.test_objects import create_from_file
+
+
+def create_workflow(name, jobs, edges):
+    workflow = factory(Workflow, name=name)
+    workflow.jobs.extend(jobs)
+    for source, destination, type in edges:
+        factory(WorkflowEdge, **{
+            'name': f'{name} {source} -> {destination}',
+            'workflow': workflow,
+            'type': type,
+            'source': workflow.jobs[source],
+            'destination': workflow.jobs[destination]
+        })
+    return workflow
+
+
+@check_blueprints('/automation')
+def test_workflow_dag(user_client):
+    # two branches that wait 1 second each, joined by the "End" job, and a
+    # job on a "Failure" edge that is skipped
+    branches = [
+        factory(Workflow, name=f'branch{index}', waiting_time=1)
+        for index in range(3)
+    ]
+    workflow = create_workflow('dag', branches, [
+        (0, 2, True),
+        (0, 3, True),
+        (2, 1, True),
+        (3, 1, True),
+        (2, 4, False),
+        (4, 1, True)
+    ])
+    start = time()
+    results = workflow.try_run()
+    assert time() - start < 2
+    assert results['success'] and 'End' in results
+    assert {'branch0', 'branch1'} <= set(results)
+    assert 'branch2' not in results
+    assert workflow.status['jobs'] == {
+        job.id: True for job in workflow.jobs[:4]
+    }
+    status = user_client.post(
+        f'/automation/workflow_status/{workflow.id}'
+    ).json
+    assert status['state'] == 'Idle' and not status['status']['current_jobs']
+    assert status['status']['jobs'] == {
+        str(job.id): True for job in workflow.jobs[:4]
+    }
+
+
+def test_workflow_branches(user_client, monkeypatch):
+    submitted, submit = [], executor.branches.submit
+    monkeypatch.setattr(
+        executor.branches,
+        'submit',
+        lambda *args: submitted.append(args) or submit(*args)
+    )
+    # the jobs of a workflow without independent branches run in the
+    # thread of the workflow
+    step = factory(Workflow, name='linear_step')
+    linear = create_workflow('linear', [step], [(0, 2, True), (2, 1, True)])
+    assert linear.try_run()['success'] and not submitted
+    # parallel branches run in the branch pool, or in the thread of the
+    # workflow when the pool is full
+    parallel = create_workflow('parallel', [
+        factory(Workflow, name=f'parallel{index}') for index in range(2)
+    ], [(0, 2, True), (0, 3, True), (2, 1, True), (3, 1, True)])
+    assert parallel.try_run()['success'] and len(submitted) == 2
+    monkeypatch.setattr(executor, 'branch_slots', BoundedSemaphore(0))
+    assert parallel.try_run()['success'] and len(submitted) == 2
+
+
+@check_blueprints('/automation')
+def test_workflow_plan(user_client):
+    job = factory(Workflow, name='step')
+    workflow = create_workflow('plan', [], [(0, 1, True)])
+    assert set(workflow.try_run()) == {'success', 'Start', 'End'}
+    plan = workflow.plan
+    start, end = plan['start'], plan['end']
+    assert (start, end) == (workflow.jobs[0].id, workflow.jobs[1].id)
+    assert plan['successors'][start] == {True: [end], False: []}
+    assert plan['in_degree'][end] == 1
+    # the plan is reused by the next runs, until the graph is modified
+    workflow.try_run()
+    assert workflow.plan is plan
+    user_client.post(f'/automation/add_node/{workflow.id}/{job.id}')
+    for source, destination in ((start, job.id), (job.id, end)):
+        user_client.post(
+            f'/automation/add_edge/{workflow.id}/true/{source}/{destination}'
+        )
+    workflow = fetch(Workflow, id=workflow.id)
+    assert 'step' in workflow.try_run()
+    assert workflow.plan['descendants'][start] == sorted([job.id, end])
+    edge = workflow.edges[0]
+    user_client.post(f'/automation/delete_edge/{workflow.id}/{edge.id}')
+    workflow = fetch(Workflow, id=workflow.id)
+    workflow.try_run()
+    assert workflow.plan['in_degree'][end] == 1
+    # edges added or changed without the workflow builder are taken into
+    # account as well
+    other = factory(Workflow, name='other_step')
+    workflow = create_workflow('factory_plan', [other], [])
+    assert set(workflow.try_run()) == {'success', 'Start'}
+    for source, destination in ((0, 2), (2, 1)):
+        factory(WorkflowEdge, **{
+            'name': f'factory_plan {source} -> {destination}',
+            'workflow': workflow,
+            'type': True,
+            'source': workflow.jobs[source],
+            'destination': workflow.jobs[destination]
+        })
+    assert {'other_step', 'End'} <= set(workflow.try_run())
+    edge = fetch(WorkflowEdge, name='factory_plan 0 -> 2')
+    edge.type = False
+    db.session.commit()
+    assert set(workflow.try_run()) == {'success', 'Start'}
+
+
+@check_blueprints('/automation')
+def test_workflow_pipeline(user_client):
+    create_from_file(user_client, 'europe.xls')
+    devices = Device.query.all()[:10]
+    service_class = service_classes['swiss_army_knife_service']
+    step = factory(service_class, name='job1', max_processes=2)
+    workflow = create_workflow('pipeline', [step], [
+        (0, 2, True),
+        (2, 1, True)
+    ])
+    workflow.multiprocessing, workflow.devices = True, devices
+    lock, in_flight, max_in_flight = Lock(), [0], [0]
+
+    def job1(self, device, payload):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        sleep(0.1)
+        with lock:
+            in_flight[0] -= 1
+        return {'success': True}
+    original_job1, service_class.job1 = service_class.job1, job1
+    try:
+        results = workflow.try_run()
+    finally:
+        service_class.job1 = original_job1
+    assert results['success'] and len(results['devices']) == 10
+    assert all(result['job1']['success']
+               for result in results['devices'].values())
+    assert max_in_flight[0] == 2
+
+
+@check_blueprints('/automation')
+def test_workflow_payload(user_client):
+    # "producer" returns results larger than the threshold: they are
+    # written to disk, read by "consumer", and deleted at the end
+    service_class = service_classes['swiss_army_knife_service']
+    jobs = [factory(service_class, name=name) for name in (
+        'producer',
+        'consumer',
+        'job2'
+    )]
+    workflow = create_workflow('payload', jobs, [
+        (0, 2, True),
+        (2, 3, True),
+        (3, 1, True),
+        (0, 4, True),
+        (4, 1, True)
+    ])
+    payloads = {}
+
+    def producer(self, payload):
+        return {'success': True, 'result': 'x' * 1000}
+
+    def consumer(self, payload):
+        payloads['consumer'] = set(payload), payload['producer']
+        return {'success': True, 'result': len(payload['producer']['result'])}
+    service_class.producer, service_class.consumer = producer, consumer
+    spill_path = mkdtemp()
+    threshold, path = payload_stores.threshold, payload_stores.path
+    payload_stores.threshold, payload_stores.path = 100, spill_path
+    try:
+        results = workflow.try_run()
+    finally:
+        payload_stores.threshold, payload_stores.path = threshold, path
+        del service_class.producer, service_class.consumer
+    # the results of the workflow refer to the logs of its jobs
+    assert results['success'] and results['consumer'] == {
+        'success': True,
+        'result': 'See the logs of "consumer"'
+    }
+    run, = fetch(Job, name='consumer').runs
+    assert run.results['result'] == 1000
+    names, producer_results = payloads['consumer']
+    assert names <= {'success', 'Start', 'producer'}
+    assert producer_results['result'] == 'x' * 1000
+    assert not list(Path(spill_path).iterdir())
+    # all results are read as JSON, whether they were written to disk or
+    # not, and a job reads its own copy of the results
+    with PayloadStore(100, spill_path) as store:
+        for name, size in (('small', 1), ('large', 100)):
+            assert store.put(name, {'result': ('x',) * size}) == (size > 1)
+        assert store.get('small') == {'result': ['x']}
+        assert store.get('large') == {'result': ['x'] * 100}
+        store.get('small')['result'].append('y')
+        assert store.get('small') == {'result': ['x']}
+    assert not list(Path(spill_path).iterdir())
 
 
 @check_blueprints('/automation')